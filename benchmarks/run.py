@@ -0,0 +1,215 @@
+"""
+Benchmarks for rendering, saving, validating and editing pages, run against an in-memory SQLite database
+with synthetic block trees.  Each benchmark reports its timings (in milliseconds) and the number of queries
+it makes, and the results are written as JSON so they can be compared between releases:
+
+    python benchmarks/run.py --width 10 --depth 3 --image-ratio 0.2 --languages 2 --output results.json
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import global_settings, settings
+
+PAGE_TEMPLATE = (
+    '{% load pageblocks %}<html><head>{% pageblocks_stylesheets page %}</head>'
+    '<body>{% pageblocks page %}{% pageblocks_scripts page %}</body></html>'
+)
+
+
+def configure(options, media_root):
+    settings.configure(
+        SECRET_KEY='benchmarks',
+        DEBUG=False,
+        INSTALLED_APPS=['django.contrib.contenttypes', 'django.contrib.auth', 'pageblocks'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {
+                'loaders': [
+                    ('django.template.loaders.locmem.Loader', {'benchmark_page.html': PAGE_TEMPLATE}),
+                    'django.template.loaders.app_directories.Loader',
+                ],
+            },
+        }],
+        USE_I18N=True,
+        LANGUAGE_CODE='en',
+        LANGUAGES=[language for language in global_settings.LANGUAGES if '-' not in language[0]][:options.languages],
+        MEDIA_ROOT=media_root,
+        DEFAULT_AUTO_FIELD='django.db.models.AutoField',
+        PAGEBLOCKS_SNAPSHOTS=options.snapshots,
+        PAGEBLOCKS_PAGE_CACHE=options.cache,
+        PAGEBLOCKS_BLOCK_CACHE=options.cache,
+    )
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def create_images(count):
+    from PIL import Image as PILImage
+    from django.core.files.base import ContentFile
+    from pageblocks.images import store_image
+
+    images = []
+    for i in range(count):
+        buffer = BytesIO()
+        PILImage.new('RGB', (64, 32), (i % 256, (i // 256) % 256, 128)).save(buffer, format='PNG')
+        image = store_image(ContentFile(buffer.getvalue(), name='benchmark-%d.png' % i))
+        images.append({'id': str(image.id), 'url': image.image.url})
+    return images
+
+
+def build_blocks(options, images, depth=None):
+    """
+    The edit data for a synthetic tree: `width` blocks at each level, the last of which is a container
+    holding the next level down.  Roughly `image_ratio` of the leaf blocks are images
+    """
+    depth = options.depth if depth is None else depth
+    languages = [language for language, _ in settings.LANGUAGES if language != settings.LANGUAGE_CODE]
+    blocks = []
+    for i in range(options.width - (1 if depth else 0)):
+        if images and int((i + 1) * options.image_ratio) > int(i * options.image_ratio):
+            image = images[(i + depth) % len(images)]
+            blocks.append({'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': image, 'alt': 'Image %d' % i},
+                           'i18n_data': {language: {'alt': '%s %d' % (language, i)} for language in languages}})
+        else:
+            blocks.append({'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<p>Block %d</p>' % i},
+                           'i18n_data': {language: {'html': '<p>%s %d</p>' % (language, i)} for language in languages}})
+
+    if depth:
+        blocks.append({'type': 'pageblocks.blocks.ContainerBlock',
+                       'data': {'class': 'level-%d' % depth, 'blocks': build_blocks(options, images, depth - 1)}})
+    return blocks
+
+
+def count_blocks(blocks, block_type=None):
+    return sum(
+        (1 if block_type in (None, block['type']) else 0) + count_blocks(block['data'].get('blocks', []), block_type)
+        for block in blocks
+    )
+
+
+def measure(name, func, repeat, setup=None):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    timings = []
+    queries = None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            func(*args)
+            timings.append((time.perf_counter() - start) * 1000)
+        queries = len(captured)
+
+    return {
+        'name': name,
+        'repeat': repeat,
+        'queries': queries,
+        'min_ms': round(min(timings), 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'mean_ms': round(statistics.mean(timings), 3),
+    }
+
+
+def run(options):
+    from django.core.cache import cache
+    from django.test import RequestFactory
+    from django.utils import translation
+    from pageblocks.blocks import BlockProcessor
+    from pageblocks.models import Page
+    from pageblocks.views import PageView
+
+    images = create_images(options.images) if options.image_ratio else []
+    blocks = build_blocks(options, images)
+    processor = BlockProcessor()
+
+    page = Page.objects.create(slug='benchmark', title={language: 'Benchmark' for language, _ in settings.LANGUAGES})
+    processor.save(page, processor.clean(copy.deepcopy(blocks)))
+    edit_data = processor.blocks_to_representation(processor.load_tree(page, use_snapshot=False))
+    created_pages = []
+
+    def fresh_page():
+        cache.clear()
+        return (Page.objects.get(pk=page.pk),)
+
+    def new_page():
+        created = Page.objects.create(slug='benchmark-%d' % len(created_pages), title={'en': 'Benchmark'})
+        created_pages.append(created)
+        return created, copy.deepcopy(blocks)
+
+    view = PageView.as_view(queryset=Page.objects.all(), template_name='benchmark_page.html')
+    request_factory = RequestFactory()
+
+    def render_view(page):
+        response = view(request_factory.get('/benchmark/'), slug=page.slug)
+        response.render()
+
+    results = []
+    with translation.override(settings.LANGUAGE_CODE):
+        results.append(measure('clean', lambda data: processor.clean(data), options.repeat,
+                               setup=lambda: (copy.deepcopy(blocks),)))
+        results.append(measure('save_new', lambda new, data: processor.save(new, processor.clean(data)), options.repeat,
+                               setup=new_page))
+        results.append(measure('save_unchanged', lambda page, data: processor.save(page, processor.clean(data)),
+                               options.repeat, setup=lambda: fresh_page() + (copy.deepcopy(edit_data),)))
+        results.append(measure('blocks_to_representation',
+                               lambda page: processor.blocks_to_representation(processor.load_tree(page, use_snapshot=False)),
+                               options.repeat, setup=fresh_page))
+        results.append(measure('render', lambda page: processor.render(processor.load_tree(page)), options.repeat,
+                               setup=fresh_page))
+        results.append(measure('render_script_tags', lambda page: processor.render_script_tags(processor.load_tree(page)),
+                               options.repeat, setup=fresh_page))
+        results.append(measure('page_view', render_view, options.repeat, setup=fresh_page))
+
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'options': vars(options),
+        'blocks': count_blocks(blocks),
+        'image_blocks': count_blocks(blocks, 'pageblocks.blocks.ImageBlock'),
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--width', type=int, default=10, help='Number of blocks at each level of the tree')
+    parser.add_argument('--depth', type=int, default=3, help='Number of nested container levels')
+    parser.add_argument('--image-ratio', type=float, default=0.2, help='Proportion of leaf blocks that are images')
+    parser.add_argument('--images', type=int, default=5, help='Number of distinct images the blocks use')
+    parser.add_argument('--languages', type=int, default=2, help='Number of languages, each block being translated into all of them')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of times to run each benchmark')
+    parser.add_argument('--snapshots', action='store_true', help='Enable PAGEBLOCKS_SNAPSHOTS')
+    parser.add_argument('--cache', action='store_true', help='Enable PAGEBLOCKS_PAGE_CACHE and PAGEBLOCKS_BLOCK_CACHE')
+    parser.add_argument('--output', default='-', help='File to write the JSON results to.  Defaults to stdout')
+    options = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as media_root:
+        configure(options, media_root)
+        results = run(options)
+
+    output = json.dumps(results, indent=2)
+    if options.output == '-':
+        print(output)
+    else:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
 from django.conf import settings
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
+from django.urls import path, reverse
+from django.utils.cache import add_never_cache_headers, patch_cache_control, patch_vary_headers
 
 from .models import Page
-from .forms import PageAdminForm
+from .forms import ImageUploadForm, PageAdminForm
+from .images import store_image
+from .registry import registry
 
 
 class PageAdmin(admin.ModelAdmin):
@@ -13,5 +19,57 @@ class PageAdmin(admin.ModelAdmin):
         obj.save()
         form.save_blocks(obj)
 
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('upload-image/', self.admin_site.admin_view(self.upload_image_view),
+                 name='%s_%s_upload_image' % info),
+            path('block-definitions/<str:fingerprint>.json', self.admin_site.admin_view(self.block_definitions_view),
+                 name='%s_%s_block_definitions' % info),
+        ] + super().get_urls()
 
-# admin.site.register(Page, PageAdmin)
\ No newline at end of file
+    def render_change_form(self, request, context, *args, **kwargs):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        blocks_field = context['adminform'].form.fields.get('blocks', None)
+        if blocks_field:
+            blocks_field.widget.upload_url = reverse('admin:%s_%s_upload_image' % info, current_app=self.admin_site.name)
+            content, fingerprint = registry.get_block_definitions(self.model.get_available_block_type_classes())
+            blocks_field.widget.blocks_url = reverse('admin:%s_%s_block_definitions' % info,
+                                                     kwargs={'fingerprint': fingerprint}, current_app=self.admin_site.name)
+        return super().render_change_form(request, context, *args, **kwargs)
+
+    def block_definitions_view(self, request, fingerprint):
+        """
+        The editor's block definitions for the current language.  The URL includes a fingerprint of the
+        content so the response can be cached indefinitely; a stale fingerprint gets the current content
+        without being cached
+        """
+        content, current_fingerprint = registry.get_block_definitions(self.model.get_available_block_type_classes())
+        response = HttpResponse(content, content_type='application/json')
+        if fingerprint == current_fingerprint:
+            patch_cache_control(response, private=True, max_age=60 * 60 * 24 * 365, immutable=True)
+        else:
+            add_never_cache_headers(response)
+        patch_vary_headers(response, ['Accept-Language', 'Cookie'])
+        return response
+
+    def upload_image_view(self, request):
+        """
+        Store an uploaded image, streaming it to the storage backend, and return its id for the block data.
+        If an identical image has already been stored, that one is returned instead
+        """
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+
+        if not self.has_add_permission(request) and not self.has_change_permission(request):
+            raise PermissionDenied
+
+        form = ImageUploadForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+
+        image = store_image(form.cleaned_data['image'])
+        return JsonResponse({'id': str(image.id), 'url': image.image.url})
+
+
+# admin.site.register(Page, PageAdmin)
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.core import checks
+
+
+class PageBlocksConfig(AppConfig):
+    name = 'pageblocks'
+
+    def ready(self):
+        from .checks import check_block_types
+        from .registry import registry
+
+        checks.register(check_block_types)
+        registry.populate()
@@ -1,24 +1,42 @@
+import asyncio
 import logging
 import base64
 import copy
 import imghdr
 import re
 import uuid
+from collections import Counter
+from functools import partial
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.template.loader import render_to_string
+from django.db import transaction
+from django.utils.safestring import mark_safe
+from django.utils import translation
 from django.utils.translation import gettext_lazy, gettext, get_language
 from django.core.files.base import ContentFile
 
-from .utils import class_from_name
+from .cache import (
+    acached_block_render, acached_page_fragment, cached_block_render, cached_page_fragment, snapshots_enabled
+)
+from .instrumentation import ameasure_block, measure, measure_block, track_queries
+from .registry import registry
+from .images import (
+    acquire_images, delete_orphaned_images, gc_on_save_enabled, get_derivatives_mode, get_image_info, get_image_sizes,
+    release_images, schedule_derivatives, store_image
+)
 from .models import Image
+from .parallel import get_rendered, is_render_worker, may_time_out, submit_render, track_timeouts
+from .signals import blocks_rendered, blocks_saved
 
 
 class BaseField(object):
     input_type = 'text'
     input_classes = []
     multi_lingual = False
+    # The types a value for this field may have, or None to accept anything
+    value_types = None
 
     def __init__(self, label=None, required=False, additional_classes=None, multi_lingual=None, *args, **kwargs):
         self.label = label
@@ -41,10 +59,12 @@ class BaseField(object):
 class CharField(BaseField):
     input_type = 'text'
     multi_lingual = True
+    value_types = (str,)
 
 class TextField(BaseField):
     input_type = 'textarea'
     multi_lingual = True
+    value_types = (str,)
 
 class HTMLField(TextField):
     input_classes = ['html']
@@ -53,10 +73,13 @@ class HTMLField(TextField):
 class ImageField(BaseField):
     input_type = 'image'
     multi_lingual = False
+    # A url, base64 data or an uploaded image's {id, url}
+    value_types = (str, dict)
 
 class BlockStreamField(BaseField):
     input_type = 'blockstream'
     block_types = None
+    value_types = (list,)
 
     def __init__(self, block_types=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -85,13 +108,54 @@ class BlockRenderingError(Exception):
     pass
 
 
+class BlockValidator(object):
+    """
+    Checks a block's data against its class's fields.  These are built once per block class (see
+    registry.get_validator), so validating each block is a single pass over a few precomputed checks
+    """
+
+    def __init__(self, block_class):
+        self.block_class = block_class
+        self.required = [field_id for field_id, field in block_class.fields if field.required]
+        self.value_types = [(field_id, field.value_types) for field_id, field in block_class.fields if field.value_types]
+        self.streams = [
+            (field_id, tuple(field.block_types) if field.block_types else None)
+            for field_id, field in block_class.fields if isinstance(field, BlockStreamField)
+        ]
+        # Blocks with their own clean() / clean_i18n() still have them called, after these checks pass
+        self.custom_clean = block_class.clean not in (BaseBlock.clean, ContainerBlock.clean)
+        self.custom_clean_i18n = block_class.clean_i18n is not BaseBlock.clean_i18n
+        # A custom clean() on a container cleans the nested blocks itself (through ContainerBlock.clean)
+        if self.custom_clean and issubclass(block_class, ContainerBlock):
+            self.streams = []
+
+    def validate(self, data):
+        """
+        A list of (field_id, message) for everything wrong with the data
+        """
+        errors = []
+        for field_id in self.required:
+            if not data.get(field_id, None):
+                errors.append((field_id, gettext('This field is required')))
+
+        for field_id, value_types in self.value_types:
+            value = data.get(field_id, None)
+            if value not in (None, '') and not isinstance(value, value_types):
+                errors.append((field_id, gettext('Invalid value')))
+
+        return errors
+
+
 class BlockProcessor(object):
     def blocks_to_representation(self, blocks, data=None):
         if not data:
             data = []
 
-        for page_block in blocks.order_by('index'):
-            block_class = class_from_name(page_block.type)
+        if hasattr(blocks, 'order_by'):
+            blocks = blocks.order_by('index')
+
+        for page_block in blocks:
+            block_class = registry.get_block_class(page_block.type)
             block = block_class(data={
                 'data': page_block.data,
                 'i18n_data': page_block.i18n_data,
@@ -107,76 +171,528 @@ class BlockProcessor(object):
         return data
 
     def clean(self, data, parent_indexes=[]):
+        """
+        Validate the data for a list of blocks, along with any blocks nested within them.  The tree is walked
+        once, collecting every error, which are raised together as a ValidationError with messages of the form
+        B:<indexes>:<field>:<message>
+        """
         if not data:
             return data
 
-        for index, block_data in enumerate(data):
-            block_class = class_from_name(block_data['type'])
-            block = block_class(data=block_data)
-            try:
-                block_data['data'] = block.clean(parent_indexes=parent_indexes + [index])
-                block_data['i18n_data'] = block.clean_i18n(parent_indexes=parent_indexes + [index])
-            except BlockValidationError as bve:
-                raise ValidationError(f'B:{self.format_index(parent_indexes, index)}:{bve.field_id}:' + str(bve))
+        errors = []
+        stack = [(block_data, list(parent_indexes) + [index], None) for index, block_data in reversed(list(enumerate(data)))]
+        while stack:
+            block_data, indexes, allowed_types = stack.pop()
+            block_class = self.get_block_class_for_cleaning(block_data, allowed_types)
+            if isinstance(block_class, str):
+                errors.append(self.format_error(indexes, 'type', block_class))
+                continue
+
+            if not isinstance(block_data.get('data', None), dict):
+                block_data['data'] = {}
+            if not isinstance(block_data.get('i18n_data', None), dict):
+                block_data['i18n_data'] = {}
+
+            validator = registry.get_validator(block_data['type'])
+            block_errors = validator.validate(block_data['data'])
+            errors += [self.format_error(indexes, field_id, message) for field_id, message in block_errors]
+            if block_errors:
+                continue
+
+            if validator.custom_clean or validator.custom_clean_i18n:
+                block = block_class(data=block_data)
+                try:
+                    if validator.custom_clean:
+                        block_data['data'] = block.clean(parent_indexes=indexes)
+                    if validator.custom_clean_i18n:
+                        block_data['i18n_data'] = block.clean_i18n(parent_indexes=indexes)
+                except BlockValidationError as bve:
+                    errors.append(self.format_error(indexes, bve.field_id, str(bve)))
+                    continue
+                except ValidationError as e:
+                    # Errors from nested blocks, already formatted with their full indexes
+                    errors += e.messages
+                    continue
 
+            for field_id, stream_types in reversed(validator.streams):
+                for index, child_data in reversed(list(enumerate(block_data['data'].get(field_id, None) or []))):
+                    stack.append((child_data, indexes + [index], stream_types))
+
+        if errors:
+            raise ValidationError(errors)
         return data
 
+    def get_block_class_for_cleaning(self, block_data, allowed_types=None):
+        """
+        The class for a block's data, or an error message if it isn't a block that can go here
+        """
+        if not isinstance(block_data, dict) or not block_data.get('type', None):
+            return gettext('Unknown block type')
+
+        try:
+            block_class = registry.get_block_class(block_data['type'])
+        except (ImportError, AttributeError, ValueError):
+            return gettext('Unknown block type')
+
+        if not isinstance(block_class, type) or not issubclass(block_class, BaseBlock):
+            return gettext('Unknown block type')
+        if allowed_types is not None and block_class not in allowed_types:
+            return gettext('This block type isn\'t allowed here')
+        return block_class
+
+    def format_error(self, indexes, field_id, message):
+        return f'B:{self.format_index(indexes[:-1], indexes[-1])}:{field_id}:{message}'
+
     def format_index(self, parent_indexes, index):
         indexes = parent_indexes + [index]
         return ','.join([str(i) for i in indexes])
 
     def save(self, page, data, parent=None):
-        processed_blocks = []
-        
+        """
+        Save a page's blocks from their cleaned data.  Existing blocks are fetched up front in a single
+        query and the resulting rows are written with bulk_create / bulk_update, all in one transaction
+        """
+        block_model = page.blocks.model
+        saved_fields = ['type', 'index', 'data', 'i18n_data', 'parent']
+        saved_attnames = [block_model._meta.get_field(field).attname for field in saved_fields]
+
+        with measure('save', blocks_saved, type(self), page=page, count=0) as measurement, transaction.atomic():
+            existing_blocks = {str(page_block.id): page_block for page_block in block_model.objects.filter(page=page)}
+            original_values = {
+                block_id: [getattr(page_block, attname) for attname in saved_attnames]
+                for block_id, page_block in existing_blocks.items()
+            }
+            previous_references = self.count_image_references(existing_blocks.values())
+
+            processed_blocks = self.get_instances_for_saving(page, data, existing_blocks, parent=parent)
+            measurement['count'] = len(processed_blocks)
+            if not parent:
+                # Nested saves (from a custom save()) are counted as part of the whole page's save
+                self.update_image_references(processed_blocks, previous_references)
+
+            block_model.objects.bulk_create([
+                instance for instance in processed_blocks if instance._state.adding
+            ])
+            block_model.objects.bulk_update([
+                instance for instance in processed_blocks
+                if str(instance.id) in original_values
+                and original_values[str(instance.id)] != [getattr(instance, attname) for attname in saved_attnames]
+            ], saved_fields)
+
+            if not parent:
+                processed_ids = {str(instance.id) for instance in processed_blocks}
+                removed_blocks = [
+                    page_block for block_id, page_block in existing_blocks.items() if block_id not in processed_ids
+                ]
+                for block_type, typed_blocks in self.group_by_type(removed_blocks).items():
+                    registry.get_block_class(block_type).delete_many(typed_blocks)
+                block_model.objects.filter(page=page, id__in=[page_block.id for page_block in removed_blocks]).delete()
+                self.save_snapshot(page, processed_blocks)
+                page.bump_content_version()
+                page.__dict__.pop('_pageblocks_render_results', None)
+                page.__dict__.pop('_pageblocks_tree', None)
+
+                if gc_on_save_enabled() and previous_references:
+                    previous_image_ids = set(previous_references)
+                    transaction.on_commit(lambda: delete_orphaned_images(previous_image_ids))
+
+        return processed_blocks
+
+    def count_image_references(self, page_blocks):
+        return Counter(
+            str(image_id) for page_block in page_blocks
+            for image_id in ImageBlock.get_image_ids(page_block.data or {}, page_block.i18n_data or {})
+        )
+
+    def update_image_references(self, page_blocks, previous_references):
+        """
+        Drop references to images that don't exist, and adjust the reference counts of the images that were
+        added or removed.  This is done once for the whole save, so it takes the same few queries however
+        many image blocks there are
+        """
+        image_ids = set(self.count_image_references(page_blocks))
+        if image_ids:
+            existing_ids = {str(image_id) for image_id in Image.objects.filter(id__in=image_ids).values_list('id', flat=True)}
+            for page_block in page_blocks:
+                for block_data in [page_block.data or {}] + list((page_block.i18n_data or {}).values()):
+                    if block_data.get('image_id', None) and str(block_data['image_id']) not in existing_ids:
+                        block_data['image_id'] = None
+
+        # Images can be shared between blocks (identical uploads are only stored once), so they're reference
+        # counted rather than deleted along with the block
+        references = self.count_image_references(page_blocks)
+        acquired = references - previous_references
+        released = previous_references - references
+        if acquired:
+            acquire_images(list(acquired.elements()))
+        if released:
+            release_images(list(released.elements()))
+
+    def get_instances_for_saving(self, page, data, existing_blocks, parent=None):
+        """
+        Build (but don't save) the page block instances for a list of block data, recursing into any
+        nested blocks
+        """
+        instances = []
+
         for block_index, block_data in enumerate(data):
-            block_class = class_from_name(block_data['type'])
+            block_class = registry.get_block_class(block_data['type'])
             block = block_class(data=block_data,
-                                instance=page.blocks.model.objects.get(page=page, id=block_data['id']) if block_data.get('id', None) else None)
+                                instance=existing_blocks.get(str(block_data['id'])) if block_data.get('id', None) else None)
 
-            processed_blocks += block.save(page=page,
-                                           block_index=block_index, parent=parent)
+            if type(block).save not in (BaseBlock.save, ContainerBlock.save):
+                # Blocks with a custom save() still write their own rows
+                instances += block.save(page=page, block_index=block_index, parent=parent)
+            else:
+                instances += block.get_instances_for_saving(page=page, block_index=block_index, parent=parent,
+                                                            processor=self, existing_blocks=existing_blocks)
 
-        if not parent:
-            cleanup_qs = page.blocks.model.objects.filter(page=page).exclude(id__in=[str(rec.id) for rec in processed_blocks])
-            cleanup_qs.delete()
+        return instances
 
-        return processed_blocks
+    def load_tree(self, page, use_snapshot=True):
+        """
+        Fetch every block for a page with a single query and assemble the tree in memory.  Returns the
+        top level blocks ordered by index, with the children of each block available via get_children().
+        When snapshots are enabled and the page has one, the tree is built from that instead
+        """
+        if use_snapshot and snapshots_enabled() and page.block_snapshot is not None:
+            return self.load_snapshot(page)
+
+        page_blocks = list(page.blocks.model.objects.filter(page=page).order_by('index'))
+        roots = self.link_tree(page, page_blocks)
+        self.prefetch(page_blocks)
+        return roots
+
+    async def aload_tree(self, page, use_snapshot=True):
+        """
+        The async version of load_tree()
+        """
+        if use_snapshot and snapshots_enabled() and page.block_snapshot is not None:
+            return self.load_snapshot(page)
+
+        page_blocks = [page_block async for page_block in page.blocks.model.objects.filter(page=page).order_by('index')]
+        roots = self.link_tree(page, page_blocks)
+        await self.aprefetch(page_blocks)
+        return roots
+
+    def link_tree(self, page, page_blocks):
+        """
+        Attach each block to its parent (and the page) in memory, returning the top level blocks
+        """
+        block_model = page.blocks.model
+        blocks_by_id = {page_block.id: page_block for page_block in page_blocks}
+
+        children = {}
+        for page_block in sorted(page_blocks, key=lambda page_block: page_block.index):
+            children.setdefault(page_block.parent_id, []).append(page_block)
+
+        for page_block in page_blocks:
+            page_block._tree_children = children.get(page_block.id, [])
+            block_model.page.field.set_cached_value(page_block, page)
+            if page_block.parent_id in blocks_by_id:
+                block_model.parent.field.set_cached_value(page_block, blocks_by_id[page_block.parent_id])
+
+        return children.get(None, [])
+
+    def build_snapshot(self, page, page_blocks):
+        """
+        A render ready copy of the page's block tree, including each block's merged data for every language
+        """
+        roots = self.link_tree(page, page_blocks)
+        self.prefetch(page_blocks)
+
+        def snapshot_nodes(nodes):
+            snapshot = []
+            for page_block in nodes:
+                block = page_block.get_block()
+                merged_data = {}
+                for language, _ in settings.LANGUAGES:
+                    with translation.override(language):
+                        merged_data[language] = block.get_merged_data(language)
+
+                snapshot.append({
+                    'id': str(page_block.id),
+                    'type': page_block.type,
+                    'index': page_block.index,
+                    'data': page_block.data,
+                    'i18n_data': page_block.i18n_data,
+                    'merged_data': merged_data,
+                    'extra': type(block).get_snapshot_data(page_block),
+                    'blocks': snapshot_nodes(page_block.get_children()),
+                })
+            return snapshot
+
+        return {'blocks': snapshot_nodes(roots)}
+
+    def load_snapshot(self, page):
+        """
+        Rebuild the block tree from the page's snapshot without touching the database
+        """
+        block_model = page.blocks.model
+
+        def load_nodes(nodes, parent):
+            page_blocks = []
+            for node in nodes:
+                page_block = block_model(id=uuid.UUID(node['id']), page=page, parent=parent, index=node['index'],
+                                         type=node['type'], data=node['data'], i18n_data=node['i18n_data'])
+                page_block._state.adding = False
+                page_block._state.db = page._state.db
+                page_block._merged_data = node['merged_data']
+                page_block._tree_children = load_nodes(node['blocks'], page_block)
+                registry.get_block_class(node['type']).load_snapshot_data(page_block, node['extra'])
+                page_blocks.append(page_block)
+            return page_blocks
+
+        return load_nodes(page.block_snapshot['blocks'], None)
+
+    def save_snapshot(self, page, page_blocks):
+        snapshot = self.build_snapshot(page, page_blocks) if snapshots_enabled() else None
+        if snapshot is not None or page.block_snapshot is not None:
+            type(page).objects.filter(pk=page.pk).update(block_snapshot=snapshot)
+            page.block_snapshot = snapshot
+
+    def rebuild_snapshots(self, pages):
+        """
+        Rebuild the snapshots of several pages from their blocks (fetched with a single query), e.g. after the
+        images they use have changed or the block code has been updated.  Cached renders of the pages are
+        invalidated as well
+        """
+        if not pages:
+            return
+
+        page_blocks = {page.pk: [] for page in pages}
+        for page_block in pages[0].blocks.model.objects.filter(page__in=pages):
+            page_blocks[page_block.page_id].append(page_block)
+
+        with transaction.atomic():
+            for page in pages:
+                self.save_snapshot(page, page_blocks[page.pk])
+                page.bump_content_version()
+                page.__dict__.pop('_pageblocks_render_results', None)
+                page.__dict__.pop('_pageblocks_tree', None)
+
+    def prefetch(self, page_blocks):
+        """
+        Give each block type the chance to load related data for all of its blocks in one go, rather than
+        once per block when it's rendered
+        """
+        for block_type, typed_blocks in self.group_by_type(page_blocks).items():
+            registry.get_block_class(block_type).prefetch(typed_blocks)
+
+    async def aprefetch(self, page_blocks):
+        for block_type, typed_blocks in self.group_by_type(page_blocks).items():
+            await registry.get_block_class(block_type).aprefetch(typed_blocks)
+
+    def group_by_type(self, page_blocks):
+        blocks_by_type = {}
+        for page_block in page_blocks:
+            blocks_by_type.setdefault(page_block.type, []).append(page_block)
+        return blocks_by_type
+
+    def render_iter(self, blocks):
+        """
+        Render a list of page blocks one at a time, yielding the HTML for each as soon as it's ready
+        """
+        blocks = [page_block.get_block() for page_block in blocks]
+        submitted = self.submit_parallel(blocks)
+        for index, block in enumerate(blocks):
+            yield get_rendered(block, *submitted[index]) if index in submitted else measure_block(block, block.render)
+
+    async def arender_iter(self, blocks):
+        """
+        The async version of render_iter().  Every block starts rendering straight away, but they're still
+        yielded in order
+        """
+        tasks = [asyncio.ensure_future(ameasure_block(page_block.get_block())) for page_block in blocks]
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def arender(self, blocks):
+        """
+        Render a list of page blocks from async code.  The blocks are rendered concurrently, so blocks that
+        wait on other services (see BaseBlock.arender) don't hold each other up
+        """
+        blocks = [page_block.get_block() for page_block in blocks]
+        with measure('render', blocks_rendered, type(self), async_code=True, count=len(blocks)):
+            return ''.join(await asyncio.gather(*[ameasure_block(block) for block in blocks]))
 
     def render(self, blocks):
-        return ''.join([block.get_block().render() for block in blocks])
+        """
+        Render a list of page blocks, handing the blocks of each type to their class together so they can
+        share a compiled template
+        """
+        blocks = [page_block.get_block() for page_block in blocks]
+
+        with measure('render', blocks_rendered, type(self), count=len(blocks)):
+            # Blocks that are safe to render in parallel are started first, so they run while the rest are rendered
+            submitted = self.submit_parallel(blocks)
+
+            indexes_by_class = {}
+            for index, block in enumerate(blocks):
+                if index not in submitted:
+                    indexes_by_class.setdefault(type(block), []).append(index)
+
+            rendered = [None] * len(blocks)
+            for block_class, indexes in indexes_by_class.items():
+                for index, html in zip(indexes, block_class.render_many([blocks[index] for index in indexes])):
+                    rendered[index] = html
+
+            for index, (future, deadline) in submitted.items():
+                rendered[index] = get_rendered(blocks[index], future, deadline)
+
+            return ''.join(rendered)
+
+    def submit_parallel(self, blocks):
+        """
+        Start rendering any parallel_safe blocks on the render pool, returning their (future, deadline) pairs
+        keyed by index.  Blocks nested within a block that's already on the pool are rendered in place, so
+        the pool can't fill up with blocks waiting on each other
+        """
+        if is_render_worker():
+            return {}
+        return {index: submit_render(block) for index, block in enumerate(blocks) if block.parallel_safe}
     
     def flatten_blocks(self, blocks):
         flattened_blocks = []
         for block in blocks:
             flattened_blocks.append(block)
-            if block.children.count() > 0:
-                flattened_blocks += self.flatten_blocks(block.children.all())
+            flattened_blocks += self.flatten_blocks(block.get_children())
         return flattened_blocks
 
-    def render_script_tags(self, blocks):
-        scripts = []
-        for block in self.flatten_blocks(blocks):
-            for script in block.get_block().get_scripts():
-                if not script:
-                    continue
+    def get_script_tags(self, blocks):
+        """
+        Script tags for every block in the tree, de-duplicated in the order they're first seen
+        """
+        return list(dict.fromkeys([
+            self.format_script_tag(script) for block in self.flatten_blocks(blocks)
+            for script in block.get_block().get_scripts() if script
+        ]))
+
+    def get_stylesheet_tags(self, blocks):
+        """
+        Stylesheet tags for every block in the tree, de-duplicated in the order they're first seen
+        """
+        return list(dict.fromkeys([
+            self.format_stylesheet_tag(ss) for block in self.flatten_blocks(blocks)
+            for ss in block.get_block().get_stylesheets() if ss
+        ]))
+
+    def format_script_tag(self, script):
+        if script[0] != '<':
+            script = '<script type="text/javascript" src="%s"></script>' % script
+        return script
+
+    def format_stylesheet_tag(self, ss):
+        if ss[0] != '<':
+            ss = '<link href="%s" rel="stylesheet" />' % ss
+        return ss
 
-                if script[0] != '<':
-                    script = '<script type="text/javascript" src="%s"></script>' % script
-                scripts.append(script)
-        return '\n'.join([script for script in set(scripts)])
+    def render_script_tags(self, blocks):
+        return '\n'.join(self.get_script_tags(blocks))
 
     def render_stylesheet_tags(self, blocks):
+        return '\n'.join(self.get_stylesheet_tags(blocks))
+
+    def render_page(self, page):
+        """
+        Render a page's blocks along with their script and stylesheet tags from a single load of the
+        block tree.  The result is memoized on the page for the active language, so the pageblocks,
+        pageblocks_scripts and pageblocks_stylesheets tags share it
+        """
+        language = get_language()
+        if not hasattr(page, '_pageblocks_render_results'):
+            page._pageblocks_render_results = {}
+
+        if language not in page._pageblocks_render_results:
+            page._pageblocks_render_results[language] = cached_page_fragment(page, 'result', lambda: self.build_render_result(page))
+        return page._pageblocks_render_results[language]
+
+    async def arender_page(self, page):
+        """
+        The async version of render_page(), sharing its memoized results
+        """
+        language = get_language()
+        if not hasattr(page, '_pageblocks_render_results'):
+            page._pageblocks_render_results = {}
+
+        if language not in page._pageblocks_render_results:
+            page._pageblocks_render_results[language] = await acached_page_fragment(
+                page, 'result', lambda: self.abuild_render_result(page)
+            )
+        return page._pageblocks_render_results[language]
+
+    def get_page_blocks(self, page):
+        """
+        The page's block tree, loaded once and memoized on the page for the rest of the request
+        """
+        if not hasattr(page, '_pageblocks_tree'):
+            page._pageblocks_tree = self.load_tree(page)
+        return page._pageblocks_tree
+
+    async def aget_page_blocks(self, page):
+        if not hasattr(page, '_pageblocks_tree'):
+            page._pageblocks_tree = await self.aload_tree(page)
+        return page._pageblocks_tree
+
+    def build_render_result(self, page):
+        blocks = self.get_page_blocks(page)
+        with track_timeouts() as timed_out:
+            html = self.render(blocks)
+        return self.get_render_result(blocks, html, complete=not timed_out)
+
+    async def abuild_render_result(self, page):
+        blocks = await self.aget_page_blocks(page)
+        with track_timeouts() as timed_out:
+            html = await self.arender(blocks)
+        # get_scripts() and get_stylesheets() may query the database
+        return await sync_to_async(self.get_render_result)(blocks, html, complete=not timed_out)
+
+    def get_render_result(self, blocks, html, complete=True):
+        scripts = []
         stylesheets = []
-        for block in self.flatten_blocks(blocks):
-            for ss in block.get_block().get_stylesheets():
-                if not ss:
-                    continue
+        for page_block in self.flatten_blocks(blocks):
+            block = page_block.get_block()
+            scripts += [self.format_script_tag(script) for script in block.get_scripts() if script]
+            stylesheets += [self.format_stylesheet_tag(ss) for ss in block.get_stylesheets() if ss]
 
-                if ss[0] != '<':
-                    ss = '<link href="%s" rel="stylesheet" />' % ss
-                stylesheets.append(ss)
+        return RenderResult(html=html,
+                            scripts=list(dict.fromkeys(scripts)),
+                            stylesheets=list(dict.fromkeys(stylesheets)),
+                            complete=complete)
+
+    def may_time_out(self, blocks):
+        """
+        Whether any of the blocks (or the blocks nested within them) could be replaced by their placeholder
+        for taking too long to render
+        """
+        return any(may_time_out(page_block.get_block()) for page_block in self.flatten_blocks(blocks))
+
+
+class RenderResult(object):
+    """
+    The rendered output of a page's blocks.  It's incomplete if a block timed out and was replaced by its
+    placeholder, in which case it shouldn't be cached
+    """
+    def __init__(self, html, scripts, stylesheets, complete=True):
+        self.html = mark_safe(html)
+        self.scripts = scripts
+        self.stylesheets = stylesheets
+        self.complete = complete
 
-        return '\n'.join([ss for ss in set(stylesheets)])
+    def __str__(self):
+        return self.html
+
+    @property
+    def script_tags(self):
+        return mark_safe('\n'.join(self.scripts))
+
+    @property
+    def stylesheet_tags(self):
+        return mark_safe('\n'.join(self.stylesheets))
 
 
 class BaseBlock(object):
@@ -186,12 +702,63 @@ class BaseBlock(object):
     block_type = None
     fields = ()
 
+    # Whether the rendered output can be cached and shared between identical blocks.  Blocks whose output
+    # depends on anything other than their data should either set this to False or add the extra
+    # dependencies in get_cache_key_extra
+    cacheable = True
+
+    # Whether the block can be rendered on a separate thread, alongside the rest of the page.  Blocks that
+    # do slow work while rendering (e.g. calling other services) can set this, as long as they don't rely on
+    # anything thread local other than the active language
+    parallel_safe = False
+
+    # How long (in seconds) to wait for a parallel_safe block before rendering render_placeholder() in its
+    # place.  Defaults to settings.PAGEBLOCKS_RENDER_TIMEOUT
+    render_timeout = None
+
     def __init__(self, data=None, instance=None, *args, **kwargs):
         self.data = data.get('data', {}) if data else {}
         self.block_type = data.get('type', None) if data else None
         self.i18n_data = data.get('i18n_data', {}) if data else {}
         self.instance = instance
 
+    @classmethod
+    def prefetch(cls, page_blocks):
+        """
+        Load any related data needed to represent or render a batch of page blocks of this type
+        """
+        pass
+
+    @classmethod
+    async def aprefetch(cls, page_blocks):
+        """
+        The async version of prefetch().  Blocks that prefetch should override this with a version that uses
+        the async ORM, otherwise their prefetch() is run in a thread
+        """
+        if cls.prefetch.__func__ is not BaseBlock.prefetch.__func__:
+            await sync_to_async(cls.prefetch)(page_blocks)
+
+    @classmethod
+    def delete_many(cls, page_blocks):
+        """
+        Clean up anything owned by a batch of page blocks of this type that are about to be deleted
+        """
+        pass
+
+    @classmethod
+    def get_snapshot_data(cls, page_block):
+        """
+        Any data loaded by prefetch() for this block that should be kept in the page's snapshot
+        """
+        return {}
+
+    @classmethod
+    def load_snapshot_data(cls, page_block, data):
+        """
+        Restore the data returned by get_snapshot_data when the block is loaded from a snapshot
+        """
+        pass
+
     @classmethod
     def serialize_field_definitions(cls):
         return {
@@ -234,33 +801,99 @@ class BaseBlock(object):
         instance.parent = parent
         return instance
 
+    def get_instances_for_saving(self, page, block_index, parent, *args, **kwargs):
+        """
+        The unsaved instances for this block and anything nested within it, for BlockProcessor to write in bulk
+        """
+        self.instance = self.get_instance_for_saving(page, block_index, parent)
+        return [self.instance]
+
     def save(self, page, block_index, parent, *args, **kwargs):
         self.instance = self.get_instance_for_saving(page, block_index, parent, *args, **kwargs)
         self.instance.save()
         return [self.instance]
 
+    @classmethod
+    def get_template(cls):
+        if not cls.template_name:
+            raise BlockRenderingError(gettext('No template_name defined for') + '.'.join([cls.__module__, cls.__name__]))
+
+        return registry.get_template(cls.template_name)
+
+    @classmethod
+    def render_many(cls, blocks):
+        """
+        Render several blocks of this class, sharing the compiled template between them
+        """
+        if cls.render is not BaseBlock.render:
+            return [measure_block(block, block.render) for block in blocks]
+
+        template = cls.get_template()
+        return [measure_block(block, partial(block.render_with_template, template)) for block in blocks]
+
     def render(self):
-        if not self.template_name:
-            raise BlockRenderingError(gettext('No template_name defined for') + '.'.join([self.__class__.__module__, self.__class__.__name__]))
+        return self.render_with_template(self.get_template())
 
-        return render_to_string(self.template_name, self.get_render_context_data())
+    def render_with_template(self, template):
+        return cached_block_render(self, lambda: template.render(self.get_render_context_data()))
 
-    def get_render_context_data(self, *args, **kwargs):
-        # Get the current language
-        current_language = get_language()
-        block_data = self.data_to_representation()
-        block_i18n_data = self.i18n_data_to_representation()
-        for lc in block_i18n_data.keys():
-            if lc == current_language:
-                for key in block_i18n_data[lc].keys():
-                    if block_i18n_data[lc][key]:
-                        block_data[key] = block_i18n_data[lc][key]
+    def render_placeholder(self):
+        """
+        Rendered in place of a parallel_safe block that takes longer than its render_timeout
+        """
+        return ''
+
+    async def arender(self):
+        """
+        Render the block from async code.  Blocks that call other services can override this to await them,
+        letting the rest of the page render in the meantime.  Anything synchronous (a custom render(), or
+        building the context and rendering the template, either of which may query the database) is run in
+        a thread
+        """
+        if type(self).render is not BaseBlock.render:
+            return await sync_to_async(track_queries(self.render))()
 
+        template = self.get_template()
+        return await acached_block_render(self, sync_to_async(
+            track_queries(lambda: template.render(self.get_render_context_data()))
+        ))
+
+    def get_cache_key_extra(self):
+        """
+        Any additional values (which must be JSON serializable) that the rendered output depends on
+        """
+        return []
+
+    def get_render_context_data(self, *args, **kwargs):
         return {
             'instance': self.instance,
-            'block': block_data
+            'block': self.get_merged_data(get_language())
         }
 
+    def get_merged_data(self, language):
+        """
+        The block's data with any translations for the given language laid over the top.  This is worked out
+        once per language and kept on the instance (snapshots come with every language already merged)
+        """
+        merged_data = getattr(self.instance, '_merged_data', None) if self.instance is not None else None
+        if merged_data is not None and language in merged_data:
+            return copy.deepcopy(merged_data[language])
+
+        block_data = dict(self.data_to_representation())
+        if self.i18n_data and self.i18n_data.get(language, None):
+            lc_data = self.data_to_representation(self.i18n_data[language], language=language) or {}
+            for key, value in lc_data.items():
+                if value:
+                    block_data[key] = value
+
+        if self.instance is None:
+            return block_data
+
+        if merged_data is None:
+            merged_data = self.instance._merged_data = {}
+        merged_data[language] = block_data
+        return copy.deepcopy(block_data)
+
     def get_scripts(self, *args, **kwargs):
         """
         Script dependencies to include for this block
@@ -295,40 +928,121 @@ class ImageBlock(BaseBlock):
         ('class', CharField(label=gettext_lazy('Class'), required=False)),
     )
 
+    @classmethod
+    def get_image_ids(cls, data, i18n_data):
+        image_ids = [data.get('image_id', None)] + [
+            lc_data.get('image_id', None) for lc_data in i18n_data.values()
+        ]
+        return [image_id for image_id in image_ids if image_id]
+
+    @classmethod
+    def resolve_images(cls, image_ids):
+        """
+        The render information (url, dimensions, srcset etc.) for each image, keyed by image id
+        """
+        return cls.get_image_infos(Image.objects.in_bulk(image_ids))
+
+    @classmethod
+    async def aresolve_images(cls, image_ids):
+        return cls.get_image_infos(await Image.objects.ain_bulk(image_ids))
+
+    @classmethod
+    def get_image_infos(cls, images):
+        if get_derivatives_mode() == 'request':
+            for image in images.values():
+                if image.image and not image.derivatives:
+                    schedule_derivatives(image.id)
+
+        return {str(image_id): get_image_info(image) for image_id, image in images.items()}
+
+    @classmethod
+    def get_snapshot_data(cls, page_block):
+        images = getattr(page_block, '_prefetched_images', {})
+        return {
+            'images': {
+                str(image_id): images[str(image_id)] for image_id in cls.get_image_ids(page_block.data, page_block.i18n_data)
+                if str(image_id) in images
+            }
+        }
+
+    @classmethod
+    def load_snapshot_data(cls, page_block, data):
+        page_block._prefetched_images = data.get('images', {})
+
+    @classmethod
+    def prefetch(cls, page_blocks):
+        images = cls.resolve_images({
+            image_id for page_block in page_blocks for image_id in cls.get_image_ids(page_block.data, page_block.i18n_data)
+        })
+        for page_block in page_blocks:
+            page_block._prefetched_images = images
+
+    @classmethod
+    async def aprefetch(cls, page_blocks):
+        images = await cls.aresolve_images({
+            image_id for page_block in page_blocks for image_id in cls.get_image_ids(page_block.data, page_block.i18n_data)
+        })
+        for page_block in page_blocks:
+            page_block._prefetched_images = images
+
+    def get_images(self):
+        """
+        The render information for every image this block references, keyed by image id.  This comes from
+        the batch loaded in prefetch() when available, otherwise it's looked up for this block in a single query
+        """
+        if self.instance is not None and hasattr(self.instance, '_prefetched_images'):
+            return self.instance._prefetched_images
+
+        if not hasattr(self, '_images'):
+            self._images = self.resolve_images(self.get_image_ids(self.data, self.i18n_data))
+        return self._images
+
+    def get_cache_key_extra(self):
+        images = self.get_images()
+        return [images.get(str(image_id), None) for image_id in self.get_image_ids(self.data, self.i18n_data)]
+
     def data_to_representation(self, data=None, **kwargs):
-        data = super().data_to_representation(data)
+        data = dict(super().data_to_representation(data))
         if data.get('image_id', None):
-            try:
-                data['image'] = Image.objects.get(id=data['image_id']).image.url
-            except Image.DoesNotExist:
-                pass
+            image = self.get_images().get(str(data['image_id']), None)
+            if image:
+                data['image'] = image['url']
+        return data
+
+    def get_merged_data(self, language):
+        data = super().get_merged_data(language)
+        image = self.get_images().get(str(data['image_id']), None) if data.get('image_id', None) else None
+        if image:
+            data.update({
+                'image_width': image['width'],
+                'image_height': image['height'],
+                'image_srcset': image['srcset'],
+                'image_sources': image['sources'],
+                'image_sizes': get_image_sizes(),
+            })
         return data
 
     def data_to_internal_value(self, data, language=None):
         # TODO: Make this multi-language - needs to be able to write to and from i18n_data if language key is set
-        image = None
-        if self.instance and self.instance.data.get('image_id', None):
-            image = Image.objects.filter(id=self.instance.data['image_id']).first()
-
-        if not data.get('image', None):
-            if image:
-                image.image.delete()
-                image.delete()
+        if language:
             return data
 
-        if not re.search('^\/|^(?i)http', data['image']):
-            if not image:
-                image = Image()
-
-            if image.image:
-                image.image.delete()
-
-            image.image = self.image_to_content_file(data['image'])
-            image.save()
+        current_image_id = self.instance.data.get('image_id', None) if self.instance else None
 
-        data['image_id'] = str(image.id) if image else None
-
-        del data['image']
+        if not data.get('image', None):
+            image_id = None
+        elif isinstance(data['image'], dict):
+            # Uploaded separately through the admin's upload endpoint, so it's already in storage
+            image_id = data['image'].get('id', None)
+        elif not re.search(r'^/|^http', data['image'], re.IGNORECASE):
+            image_id = store_image(self.image_to_content_file(data['image'])).id
+        else:
+            image_id = current_image_id or data.get('image_id', None)
+
+        # Whether the image exists, and its reference count, are checked by BlockProcessor.save for every
+        # block at once
+        data['image_id'] = str(image_id) if image_id else None
+        data.pop('image', None)
         return data
 
     def image_to_content_file(self, data):
@@ -364,6 +1078,9 @@ class ContainerBlock(BaseBlock):
         ('blocks', BlockStreamField(label=gettext_lazy('Blocks'), required=True))
     )
 
+    # The output depends on the child blocks, which are cached individually instead
+    cacheable = False
+
     def clean(self, parent_indexes=[], *args, **kwargs):
         data = super().clean(*args, **kwargs)
         BlockProcessor().clean(data['blocks'], parent_indexes=parent_indexes)
@@ -375,15 +1092,30 @@ class ContainerBlock(BaseBlock):
 
         data = super().data_to_representation(data)
         if self.instance:
-            data['blocks'] = BlockProcessor().blocks_to_representation(self.instance.children.all())
+            data['blocks'] = BlockProcessor().blocks_to_representation(self.instance.get_children())
         return data
 
+    def get_instances_for_saving(self, page, block_index, parent, processor, existing_blocks, *args, **kwargs):
+        if not self.instance:
+            self.instance = page.blocks.model(page=page)
+
+        block_data = copy.deepcopy(self.data)
+        sub_blocks = processor.get_instances_for_saving(page, block_data.pop('blocks'), existing_blocks,
+                                                        parent=self.instance)
+
+        self.instance.type = self.block_type
+        self.instance.data = block_data
+        self.instance.index = block_index
+        self.instance.parent = parent
+
+        return [self.instance] + sub_blocks
+
     def save(self, page, block_index, parent, *args, **kwargs):
         if not self.instance:
             self.instance = page.blocks.model(page=page)
 
         block_data = copy.deepcopy(self.data)
-        sub_blocks = BlockProcessor().save(page, block_data.pop('blocks'), parent=self.instance)
+        sub_blocks = block_data.pop('blocks')
 
         self.instance.type = self.block_type
         self.instance.data = block_data
@@ -391,10 +1123,29 @@ class ContainerBlock(BaseBlock):
         self.instance.parent = parent
         self.instance.save()
 
-        return [self.instance] + sub_blocks
+        return [self.instance] + BlockProcessor().save(page, sub_blocks, parent=self.instance)
+
+    def get_merged_data(self, language):
+        # The child blocks are rendered from the tree, so there's no need for their representation here
+        return {key: value for key, value in self.data.items() if key != 'blocks'}
 
     def get_render_context_data(self, *args, **kwargs):
         ctx = super().get_render_context_data(*args, **kwargs)
-        ctx['blocks'] = self.instance.children.all().order_by('index')
+        ctx['blocks'] = self.instance.get_children()
         return ctx
 
+    async def arender(self):
+        if type(self).render is not BaseBlock.render:
+            return await super().arender()
+
+        # Render the children concurrently first, and hand their output to the template in place of the blocks
+        processor = BlockProcessor()
+        html = await processor.arender(self.instance.get_children())
+
+        def render_template():
+            ctx = self.get_render_context_data()
+            ctx['blocks'] = RenderResult(html=html, scripts=[], stylesheets=[])
+            return self.get_template().render(ctx)
+
+        return await sync_to_async(track_queries(render_template))()
+
@@ -0,0 +1,125 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.utils.translation import get_language
+
+from .instrumentation import record_cache_result
+
+
+def get_cache():
+    return caches[getattr(settings, 'PAGEBLOCKS_CACHE_ALIAS', 'default')]
+
+
+def get_cache_timeout():
+    return getattr(settings, 'PAGEBLOCKS_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def page_cache_enabled():
+    return getattr(settings, 'PAGEBLOCKS_PAGE_CACHE', False)
+
+
+def snapshots_enabled():
+    return getattr(settings, 'PAGEBLOCKS_SNAPSHOTS', False)
+
+
+def get_page_cache_key(page, fragment):
+    """
+    Cache keys include the page's content version, so saving the page's blocks moves readers on to a
+    fresh key rather than needing to purge the old one
+    """
+    return 'pageblocks:page:%s:%s:%s:%s:%s' % (
+        page._meta.label_lower, page.pk, page.content_version, get_language(), fragment
+    )
+
+
+def cached_page_fragment(page, fragment, render):
+    """
+    Return the rendered fragment for a page from the cache, calling render() to build it on a miss.  Renders
+    that aren't complete (see RenderResult) aren't kept
+    """
+    if not page_cache_enabled():
+        return render()
+
+    cache = get_cache()
+    key = get_page_cache_key(page, fragment)
+    value = cache.get(key)
+    if value is None:
+        value = render()
+        if getattr(value, 'complete', True):
+            cache.set(key, value, get_cache_timeout())
+    return value
+
+
+async def acached_page_fragment(page, fragment, render):
+    """
+    The async version of cached_page_fragment(), where render() returns an awaitable
+    """
+    if not page_cache_enabled():
+        return await render()
+
+    cache = get_cache()
+    key = get_page_cache_key(page, fragment)
+    value = await cache.aget(key)
+    if value is None:
+        value = await render()
+        if getattr(value, 'complete', True):
+            await cache.aset(key, value, get_cache_timeout())
+    return value
+
+
+def block_cache_enabled():
+    return getattr(settings, 'PAGEBLOCKS_BLOCK_CACHE', False)
+
+
+def get_block_cache_key(block):
+    """
+    Blocks are keyed on their content rather than their id, so identical blocks share a cache entry
+    across pages
+    """
+    key_material = json.dumps([
+        block.block_type,
+        block.data,
+        block.i18n_data,
+        get_language(),
+        block.template_name,
+        block.get_cache_key_extra(),
+    ], sort_keys=True, cls=DjangoJSONEncoder)
+    return 'pageblocks:block:%s' % hashlib.sha256(key_material.encode()).hexdigest()
+
+
+def cached_block_render(block, render):
+    """
+    Return the rendered output for a block from the cache, calling render() to build it on a miss
+    """
+    if not block.cacheable or not block_cache_enabled():
+        return render()
+
+    cache = get_cache()
+    key = get_block_cache_key(block)
+    value = cache.get(key)
+    record_cache_result(value is not None)
+    if value is None:
+        value = render()
+        cache.set(key, value, get_cache_timeout())
+    return value
+
+
+async def acached_block_render(block, render):
+    """
+    The async version of cached_block_render(), where render is a coroutine function
+    """
+    if not block.cacheable or not block_cache_enabled():
+        return await render()
+
+    cache = get_cache()
+    key = get_block_cache_key(block)
+    value = await cache.aget(key)
+    record_cache_result(value is not None)
+    if value is None:
+        value = await render()
+        await cache.aset(key, value, get_cache_timeout())
+    return value
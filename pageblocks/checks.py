@@ -0,0 +1,48 @@
+from django.core.checks import Error, Warning
+
+from .registry import get_available_block_types
+from .utils import class_from_name
+
+
+def check_block_types(app_configs, **kwargs):
+    """
+    Make sure every configured block type can be imported and is a block, so a misconfigured type fails
+    at startup rather than when a page is rendered
+    """
+    from .blocks import BaseBlock, BlockStreamField
+
+    errors = []
+    block_types = get_available_block_types()
+
+    for block_type in block_types:
+        try:
+            block_class = class_from_name(block_type)
+        except (ImportError, AttributeError, ValueError) as e:
+            errors.append(Error(
+                'Unable to import block type %s: %s' % (block_type, e),
+                hint='Check the entries in PAGEBLOCKS_AVAILABLE_BLOCKS.',
+                id='pageblocks.E001',
+            ))
+            continue
+
+        if not isinstance(block_class, type) or not issubclass(block_class, BaseBlock):
+            errors.append(Error(
+                '%s is not a subclass of pageblocks.blocks.BaseBlock' % block_type,
+                id='pageblocks.E002',
+            ))
+            continue
+
+        for field_id, field in block_class.fields:
+            if not isinstance(field, BlockStreamField):
+                continue
+
+            for nested_class in field.block_types or []:
+                nested_type = nested_class.__module__ + '.' + nested_class.__name__
+                if nested_type not in block_types:
+                    errors.append(Warning(
+                        'The %s field of %s allows %s, which is not an available block type' % (field_id, block_type, nested_type),
+                        hint='Add it to PAGEBLOCKS_AVAILABLE_BLOCKS so it can be used in the editor.',
+                        id='pageblocks.W001',
+                    ))
+
+    return errors
@@ -1,5 +1,6 @@
 import base64
 import json
+import uuid
 
 from django.conf import settings
 from django import forms
@@ -7,8 +8,8 @@ from django.core.exceptions import ValidationError
 from django.utils.translation import get_language, gettext
 from django.utils.text import slugify
 
-from .models import Page, PageBlock
-from .utils import class_from_name
+from .models import Image, Page, PageBlock
+from .registry import registry
 from .blocks import BlockProcessor
 
 
@@ -29,15 +30,18 @@ class MultiLanguageInput(LanguagesInputMixin, forms.TextInput):
 class PageBlockEditor(LanguagesInputMixin, forms.TextInput):
     template_name = 'admin/pageblocks/block_editor.html'
 
+    # Set by PageAdmin so images can be uploaded separately rather than as base64 data in the form
+    upload_url = None
+    # Set by PageAdmin so the block definitions can be fetched (and cached) separately rather than inlined
+    blocks_url = None
+
     def get_context(self, *args, **kwargs):
         ctx = super().get_context(*args, **kwargs)
-        ctx['blocks'] = base64.b64encode(json.dumps({
-            block_id: {
-                'name': str(block_class.name),
-                'description': str(block_class.description),
-                'fields': block_class.serialize_field_definitions()
-            } for block_id, block_class in Page.get_available_blocks()
-        }).encode()).decode()
+        ctx['upload_url'] = self.upload_url
+        ctx['blocks_url'] = self.blocks_url
+        if not self.blocks_url:
+            content, fingerprint = registry.get_block_definitions(Page.get_available_block_type_classes())
+            ctx['blocks'] = base64.b64encode(content.encode()).decode()
         ctx['translations'] = base64.b64encode(json.dumps({
             'labelBtnAdd': gettext('Add'),
             'labelUnknown': gettext('Unknown'),
@@ -63,7 +67,11 @@ class PageAdminForm(forms.ModelForm):
             self.init_blocks()
 
     def init_blocks(self):
-        self.fields['blocks'].initial = BlockProcessor().blocks_to_representation(self.instance.blocks.filter(parent=None))
+        # Build the representation from the whole tree, fetched at once, rather than querying each container's children
+        processor = BlockProcessor()
+        self.fields['blocks'].initial = processor.blocks_to_representation(
+            processor.load_tree(self.instance, use_snapshot=False)
+        )
 
     def clean(self):
         data = self.cleaned_data
@@ -102,3 +110,14 @@ class PageAdminForm(forms.ModelForm):
             block_data = {}
 
         BlockProcessor().save(page, block_data)
+
+
+class ImageUploadForm(forms.ModelForm):
+    class Meta:
+        model = Image
+        fields = ('image',)
+
+    def clean_image(self):
+        image = self.cleaned_data['image']
+        image.name = '%s.%s' % (str(uuid.uuid4())[:12], image.name.rsplit('.', 1)[-1].lower() if '.' in image.name else 'jpg')
+        return image
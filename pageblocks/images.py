@@ -0,0 +1,335 @@
+import hashlib
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .cache import snapshots_enabled
+
+MIME_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+
+
+def get_derivatives_mode():
+    """
+    When to generate derivatives: 'background' (as soon as an image is saved), 'request' (the first time it's
+    rendered) or None to not generate them at all
+    """
+    return getattr(settings, 'PAGEBLOCKS_IMAGE_DERIVATIVES', None)
+
+
+def get_derivative_widths():
+    return getattr(settings, 'PAGEBLOCKS_IMAGE_WIDTHS', [480, 960, 1440, 1920])
+
+
+def get_derivative_formats():
+    """
+    Formats to generate in addition to the original's (e.g. ['webp'])
+    """
+    return getattr(settings, 'PAGEBLOCKS_IMAGE_FORMATS', [])
+
+
+def get_image_sizes():
+    return getattr(settings, 'PAGEBLOCKS_IMAGE_SIZES', '100vw')
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PAGEBLOCKS_IMAGE_WORKERS', 2),
+                                           thread_name_prefix='pageblocks-images')
+        return _executor
+
+
+def schedule_derivatives(image_id):
+    """
+    Generate the derivatives for an image on the background thread pool, unless it's already queued
+    """
+    image_id = str(image_id)
+    with _executor_lock:
+        if image_id in _pending:
+            return
+        _pending.add(image_id)
+
+    get_executor().submit(generate_derivatives_for_id, image_id)
+
+
+def generate_derivatives_for_id(image_id):
+    from .models import Image
+
+    try:
+        image = Image.objects.filter(id=image_id).first()
+        if image and image.image:
+            generate_derivatives(image)
+    except Exception:
+        logging.exception('Unable to generate derivatives for image %s' % image_id)
+    finally:
+        with _executor_lock:
+            _pending.discard(image_id)
+        connections.close_all()
+
+
+def generate_derivatives(image):
+    """
+    Resize an image to each of the configured widths (that are smaller than the original), in its own
+    format and each additional format, and record the results on the image
+    """
+    from PIL import Image as PILImage
+
+    with image.image.open('rb') as f:
+        source = PILImage.open(f)
+        source.load()
+
+    source_format = (source.format or 'jpeg').lower()
+    storage = image.image.storage
+    delete_derivatives(image)
+
+    derivatives = {source_format: {}}
+    for image_format in [source_format] + [f for f in get_derivative_formats() if f != source_format]:
+        derivatives.setdefault(image_format, {})
+        for width in get_derivative_widths():
+            if width >= source.width:
+                continue
+
+            resized = source.resize((width, max(1, round(source.height * width / source.width))), PILImage.LANCZOS)
+            if image_format == 'jpeg' and resized.mode not in ('RGB', 'L'):
+                resized = resized.convert('RGB')
+
+            buffer = BytesIO()
+            resized.save(buffer, format=image_format.upper())
+            name = 'pageblocks/derivatives/%s/%d.%s' % (image.pk, width, 'jpg' if image_format == 'jpeg' else image_format)
+            derivatives[image_format][str(width)] = storage.save(name, ContentFile(buffer.getvalue()))
+
+    image.width, image.height, image.derivatives = source.width, source.height, derivatives
+    image.image_format = source_format
+    type(image).objects.filter(pk=image.pk).update(width=image.width, height=image.height, derivatives=derivatives,
+                                                   image_format=source_format)
+    refresh_pages([image.pk])
+
+
+def delete_derivatives(image):
+    storage = image.image.storage
+    for widths in (image.derivatives or {}).values():
+        for name in widths.values():
+            storage.delete(name)
+
+
+def get_image_info(image):
+    """
+    Everything needed to render an image: its url, dimensions and the srcset for each format
+    """
+    storage = image.image.storage
+    derivatives = image.derivatives or {}
+    # Stored separately, as the database may not keep the order of the derivatives' keys
+    original_format = image.image_format
+
+    def srcset(image_format):
+        candidates = ['%s %sw' % (storage.url(name), width) for width, name in
+                      sorted(derivatives.get(image_format, {}).items(), key=lambda item: int(item[0]))]
+        if image_format == original_format and image.width:
+            candidates.append('%s %dw' % (image.image.url, image.width))
+        return ', '.join(candidates)
+
+    return {
+        'url': image.image.url,
+        'width': image.width,
+        'height': image.height,
+        'srcset': srcset(original_format) if derivatives.get(original_format) else '',
+        'sources': [
+            {'type': MIME_TYPES.get(image_format, 'image/%s' % image_format), 'srcset': srcset(image_format)}
+            for image_format in derivatives.keys() if image_format != original_format and derivatives[image_format]
+        ],
+    }
+
+
+def hash_file(f):
+    content_hash = hashlib.sha256()
+    for chunk in f.chunks():
+        content_hash.update(chunk)
+    f.seek(0)
+    return content_hash.hexdigest()
+
+
+def store_image(f):
+    """
+    Store an image file, or return the existing image if an identical file has already been stored.  The
+    returned image's references are managed by the blocks that use it (see acquire_images / release_images)
+    """
+    from .models import Image
+
+    content_hash = hash_file(f)
+    image = Image.objects.filter(content_hash=content_hash).first()
+    if image is None:
+        image = Image(image=f, content_hash=content_hash)
+        image.save()
+    return image
+
+
+def acquire_images(image_ids):
+    from .models import Image
+
+    for image_id, count in Counter(str(image_id) for image_id in image_ids).items():
+        Image.objects.filter(id=image_id).update(ref_count=F('ref_count') + count)
+
+
+def release_images(image_ids):
+    """
+    Drop a reference to each image, deleting any that are no longer used.  Files are only removed from
+    storage once the surrounding transaction commits
+    """
+    from .models import Image
+
+    counts = Counter(str(image_id) for image_id in image_ids)
+    for image_id, count in counts.items():
+        Image.objects.filter(id=image_id).update(ref_count=Greatest(F('ref_count') - count, 0))
+
+    deleted_ids = []
+    for image in Image.objects.filter(id__in=list(counts.keys()), ref_count=0):
+        delete_image(image)
+        deleted_ids.append(image.pk)
+
+    if deleted_ids:
+        transaction.on_commit(lambda: refresh_pages(deleted_ids))
+
+
+def delete_image(image):
+    names = [image.image.name] + [name for widths in (image.derivatives or {}).values() for name in widths.values()]
+    storage = image.image.storage
+    type(image).objects.filter(pk=image.pk).delete()
+    transaction.on_commit(lambda: [storage.delete(name) for name in names if name])
+
+
+def get_block_models():
+    from .models import AbstractPageBlock
+
+    return [model for model in apps.get_models() if issubclass(model, AbstractPageBlock)]
+
+
+def get_referenced_image_ids(image_ids=None):
+    """
+    The ids of every image referenced by a block, optionally limited to the given ids.  Each block model is
+    checked with one query for the block data and one per language for the translations
+    """
+    referenced = set()
+    for block_model in get_block_models():
+        lookups = ['data'] + ['i18n_data__%s' % language for language, _ in settings.LANGUAGES]
+        for lookup in lookups:
+            qs = block_model.objects.filter(**{'%s__has_key' % lookup: 'image_id'})
+            if image_ids is not None:
+                qs = qs.filter(**{'%s__image_id__in' % lookup: [str(image_id) for image_id in image_ids]})
+            referenced.update(str(image_id) for image_id in qs.values_list('%s__image_id' % lookup, flat=True) if image_id)
+    return referenced
+
+
+def get_pages_using_images(image_ids):
+    """
+    Yield (page model, page ids) for the pages that have a block referencing any of the given images
+    """
+    image_ids = [str(image_id) for image_id in image_ids]
+    for block_model in get_block_models():
+        page_ids = set()
+        for lookup in ['data'] + ['i18n_data__%s' % language for language, _ in settings.LANGUAGES]:
+            page_ids.update(block_model.objects.filter(**{'%s__image_id__in' % lookup: image_ids})
+                            .values_list('page_id', flat=True))
+
+        if page_ids:
+            yield block_model._meta.get_field('page').related_model, page_ids
+
+
+def refresh_pages(image_ids):
+    """
+    Invalidate the cached renders (and ETags) of the pages that use any of the given images, rebuilding
+    their snapshots when enabled, so they pick up newly generated derivatives and stop referring to deleted
+    images
+    """
+    from .blocks import BlockProcessor
+
+    for page_model, page_ids in get_pages_using_images(image_ids):
+        queryset = page_model.objects.filter(pk__in=page_ids)
+        if snapshots_enabled():
+            # Rebuilding a snapshot bumps the page's content version as well
+            BlockProcessor().rebuild_snapshots(list(queryset.filter(block_snapshot__isnull=False)))
+            queryset = queryset.filter(block_snapshot__isnull=True)
+        queryset.update(content_version=F('content_version') + 1, modified=timezone.now())
+
+
+def find_orphaned_images(image_ids=None, min_age=None, batch_size=500):
+    """
+    Yield batches of images that aren't referenced by any block.  Images newer than min_age (a timedelta) are
+    skipped, as they may have been uploaded for a page that hasn't been saved yet
+    """
+    from .models import Image
+
+    qs = Image.objects.all()
+    if image_ids is not None:
+        qs = qs.filter(id__in=list(image_ids))
+    if min_age is not None:
+        qs = qs.filter(created__lte=timezone.now() - min_age)
+
+    referenced = get_referenced_image_ids(image_ids)
+    batch = []
+    for image in qs.only('id', 'image', 'derivatives').order_by('pk').iterator(chunk_size=batch_size):
+        if str(image.id) in referenced:
+            continue
+
+        batch.append(image)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def delete_images(images, concurrency=4):
+    """
+    Delete a batch of images, removing their rows in one query and then their files (and derivatives) from
+    storage with up to `concurrency` delete calls at a time
+    """
+    from .models import Image
+
+    files = [
+        (image.image.storage, name) for image in images
+        for name in [image.image.name] + [name for widths in (image.derivatives or {}).values() for name in widths.values()]
+        if name
+    ]
+    Image.objects.filter(id__in=[image.id for image in images]).delete()
+    refresh_pages([image.id for image in images])
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        list(executor.map(lambda file: file[0].delete(file[1]), files))
+
+
+def delete_orphaned_images(image_ids=None, min_age=None, batch_size=500, concurrency=4, dry_run=False):
+    """
+    Find and delete images that aren't referenced by any block, returning how many there were
+    """
+    count = 0
+    for batch in find_orphaned_images(image_ids=image_ids, min_age=min_age, batch_size=batch_size):
+        count += len(batch)
+        if not dry_run:
+            delete_images(batch, concurrency=concurrency)
+    return count
+
+
+def gc_on_save_enabled():
+    return getattr(settings, 'PAGEBLOCKS_IMAGE_GC_ON_SAVE', False)
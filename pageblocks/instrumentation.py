@@ -0,0 +1,151 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.db import connection
+
+from .signals import block_rendered
+
+_collector = ContextVar('pageblocks_collector', default=None)
+_measurement = ContextVar('pageblocks_measurement', default=None)
+_async_measurements = ContextVar('pageblocks_async_measurements', default=())
+
+
+class Collector(object):
+    """
+    Gathers the measurements made while it's active (see collect()), e.g. for the duration of a request
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, kind, **data):
+        self.records.append(dict(data, kind=kind))
+
+    def get_summary(self):
+        """
+        Totals for each kind of measurement
+        """
+        summary = {}
+        for record in self.records:
+            totals = summary.setdefault(record['kind'], {'count': 0, 'duration': 0, 'queries': 0,
+                                                         'cache_hits': 0, 'cache_misses': 0})
+            totals['count'] += 1
+            totals['duration'] += record['duration']
+            totals['queries'] += record['queries']
+            if record.get('cache', None) == 'hit':
+                totals['cache_hits'] += 1
+            elif record.get('cache', None) == 'miss':
+                totals['cache_misses'] += 1
+        return summary
+
+    def get_slowest_blocks(self, count=5):
+        return sorted([record for record in self.records if record['kind'] == 'block'],
+                      key=lambda record: record['duration'], reverse=True)[:count]
+
+
+def get_collector():
+    return _collector.get()
+
+
+@contextmanager
+def collect(collector=None):
+    """
+    Record every measurement made within the block on a collector
+    """
+    collector = collector if collector is not None else Collector()
+    token = _collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _collector.reset(token)
+
+
+@contextmanager
+def measure(kind, signal, sender, async_code=False, **data):
+    """
+    Time the wrapped code and count the queries it makes on the default database, then hand the results to
+    the active collector and the signal's receivers.  When neither is listening this does nothing, so it
+    costs next to nothing to leave in place.
+
+    Async code makes its queries from other threads (through sync_to_async), so with async_code only the
+    time is measured here, and the queries are counted by the sync functions wrapped with track_queries()
+    """
+    collector = _collector.get()
+    if collector is None and not signal.has_listeners(sender):
+        yield data
+        return
+
+    data['queries'] = 0
+
+    def count_queries(execute, sql, params, many, context):
+        data['queries'] += 1
+        return execute(sql, params, many, context)
+
+    token = _measurement.set(data)
+    async_token = _async_measurements.set(_async_measurements.get() + (data,)) if async_code else None
+    start = time.perf_counter()
+    try:
+        if async_code:
+            yield data
+        else:
+            with connection.execute_wrapper(count_queries):
+                yield data
+    finally:
+        _measurement.reset(token)
+        if async_token is not None:
+            _async_measurements.reset(async_token)
+
+    data.update(duration=(time.perf_counter() - start) * 1000)
+    if collector is not None:
+        collector.record(kind, **data)
+    signal.send(sender=sender, **data)
+
+
+def track_queries(func):
+    """
+    Wrap a sync function that's run in a thread from async code, so the queries it makes are counted towards
+    the async measurements (see measure()) it's running within
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        measurements = _async_measurements.get()
+        if not measurements:
+            return func(*args, **kwargs)
+
+        def count_queries(execute, sql, params, many, context):
+            for data in measurements:
+                data['queries'] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def measure_block(block, render):
+    """
+    Render a block with render(), measuring it along the way
+    """
+    with measure('block', block_rendered, type(block), block_type=block.block_type,
+                 block_id=str(block.instance.id) if block.instance is not None else None, cache=None):
+        return render()
+
+
+async def ameasure_block(block):
+    """
+    Render a block with its arender(), measuring it along the way
+    """
+    with measure('block', block_rendered, type(block), async_code=True, block_type=block.block_type,
+                 block_id=str(block.instance.id) if block.instance is not None else None, cache=None):
+        return await block.arender()
+
+
+def record_cache_result(hit):
+    """
+    Note whether the block currently being measured was served from the cache
+    """
+    data = _measurement.get()
+    if data is not None and 'cache' in data:
+        data['cache'] = 'hit' if hit else 'miss'
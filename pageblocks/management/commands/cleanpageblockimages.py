@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from ...images import delete_orphaned_images
+
+
+class Command(BaseCommand):
+    help = 'Delete images (and their files) that are no longer referenced by any block'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report how many images would be deleted without deleting them')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of images to delete at a time')
+        parser.add_argument('--concurrency', type=int, default=4,
+                            help='Maximum number of storage delete calls to make at once')
+        parser.add_argument('--min-age', type=float, default=24,
+                            help='Only delete images older than this many hours, as newer ones may have been '
+                                 'uploaded for a page that hasn\'t been saved yet')
+
+    def handle(self, dry_run=False, batch_size=500, concurrency=4, min_age=24, **options):
+        count = delete_orphaned_images(min_age=timedelta(hours=min_age), batch_size=batch_size,
+                                       concurrency=concurrency, dry_run=dry_run)
+        if dry_run:
+            self.stdout.write('%d orphaned image(s) would be deleted' % count)
+        else:
+            self.stdout.write('Deleted %d orphaned image(s)' % count)
@@ -0,0 +1,79 @@
+import json
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+def get_page_fields(page_model):
+    """
+    The fields of a page that are dumped and loaded: every concrete field that can be edited.  The primary key
+    and the fields pageblocks maintains itself (content_version, modified, block_snapshot) are left out
+    """
+    return [field for field in page_model._meta.concrete_fields if field.editable and not field.primary_key]
+
+
+def serialize_blocks(children, parent_id=None):
+    return [
+        {
+            'type': page_block.type,
+            'data': page_block.data,
+            'i18n_data': page_block.i18n_data,
+            'blocks': serialize_blocks(children, page_block.id),
+        } for page_block in children.get(parent_id, [])
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Write every page, along with its blocks, as JSON Lines (one page per line)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default='-',
+                            help='File to write to.  Defaults to stdout')
+        parser.add_argument('--model', default='pageblocks.Page',
+                            help='The page model to dump, as app_label.ModelName')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of pages (and their blocks) to load at a time')
+
+    def handle(self, output='-', model='pageblocks.Page', chunk_size=500, **options):
+        try:
+            page_model = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        f = self.stdout if output == '-' else open(output, 'w')
+        try:
+            count = 0
+            fields = get_page_fields(page_model)
+            for pages in self.get_chunks(page_model.objects.order_by('pk'), chunk_size):
+                for page, children in self.get_block_trees(page_model, pages):
+                    page_data = {field.name: field.value_from_object(page) for field in fields}
+                    page_data['blocks'] = serialize_blocks(children)
+                    f.write(json.dumps(page_data, cls=DjangoJSONEncoder) + '\n')
+                    count += 1
+        finally:
+            if f is not self.stdout:
+                f.close()
+
+        self.stderr.write('Dumped %d page(s)' % count)
+
+    def get_chunks(self, queryset, chunk_size):
+        chunk = []
+        for page in queryset.iterator(chunk_size=chunk_size):
+            chunk.append(page)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def get_block_trees(self, page_model, pages):
+        """
+        The blocks for a chunk of pages, fetched in one query and grouped by page and then parent
+        """
+        block_model = page_model.blocks.rel.related_model
+        children = {page.pk: {} for page in pages}
+        for page_block in block_model.objects.filter(page__in=pages).order_by('index'):
+            children[page_block.page_id].setdefault(page_block.parent_id, []).append(page_block)
+
+        return [(page, children[page.pk]) for page in pages]
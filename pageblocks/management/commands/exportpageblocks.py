@@ -0,0 +1,142 @@
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import RequestFactory
+from django.utils import translation
+
+from ...utils import class_from_name
+
+MANIFEST_NAME = '.pageblocks-export.json'
+
+
+def get_page_version(page):
+    return '%s:%s' % (page.content_version, page.modified.isoformat() if page.modified else '')
+
+
+def export_pages(view_path, output_dir, pages):
+    """
+    Render a batch of pages (as (pk, slug, version) tuples) to static files for every language.  This runs
+    in the worker processes, so it only deals in values that can be pickled
+    """
+    view = class_from_name(view_path).as_view()
+    request_factory = RequestFactory()
+    exported = []
+
+    for pk, slug, version in pages:
+        for language, _ in settings.LANGUAGES:
+            with translation.override(language):
+                response = view(request_factory.get('/%s/%s/' % (language, slug)), slug=slug)
+                if hasattr(response, 'render'):
+                    response.render()
+
+                if response.status_code != 200:
+                    continue
+
+                page_dir = os.path.join(output_dir, language, slug)
+                os.makedirs(page_dir, exist_ok=True)
+                with open(os.path.join(page_dir, 'index.html'), 'wb') as f:
+                    if response.streaming:
+                        for chunk in response.streaming_content:
+                            f.write(chunk)
+                    else:
+                        f.write(response.content)
+
+        exported.append((str(pk), version))
+
+    return exported
+
+
+def init_worker():
+    django.setup()
+
+
+class Command(BaseCommand):
+    help = 'Render every page to static HTML files, one per language'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_dir')
+        parser.add_argument('--view', default=getattr(settings, 'PAGEBLOCKS_EXPORT_VIEW', None),
+                            help='Dotted path to the PageView subclass used to render (and select) the pages. '
+                                 'Defaults to settings.PAGEBLOCKS_EXPORT_VIEW')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of processes to render with')
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help='Number of pages handed to a worker at a time')
+        parser.add_argument('--incremental', action='store_true',
+                            help='Only export pages that have changed since the last export')
+
+    def handle(self, output_dir, view=None, workers=1, chunk_size=100, incremental=False, **options):
+        if not view:
+            raise CommandError('No view to render pages with.  Pass --view or set PAGEBLOCKS_EXPORT_VIEW')
+
+        try:
+            view_class = class_from_name(view)
+        except (ImportError, AttributeError, ValueError) as e:
+            raise CommandError('Unable to import %s: %s' % (view, e))
+
+        os.makedirs(output_dir, exist_ok=True)
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        manifest = {}
+        if incremental and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        queryset = view_class().get_queryset().only('pk', 'slug', 'content_version', 'modified').order_by('pk')
+        chunks = self.get_chunks(queryset, manifest, chunk_size)
+
+        if workers > 1:
+            exported = []
+            pending = set()
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+                for chunk in chunks:
+                    # Only a couple of chunks per worker are queued at a time, so pages are rendered while
+                    # the rest are still being read
+                    if len(pending) >= workers * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        exported += [page for future in done for page in future.result()]
+
+                    # Worker processes can be started on any submit, and need their own database connections
+                    connections.close_all()
+                    pending.add(executor.submit(export_pages, view, output_dir, chunk))
+
+                exported += [page for future in pending for page in future.result()]
+        else:
+            exported = [page for chunk in chunks for page in export_pages(view, output_dir, chunk)]
+
+        manifest.update(dict(exported))
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+        self.stdout.write('Exported %d page(s)' % len(exported))
+
+    def get_chunks(self, queryset, manifest, chunk_size):
+        """
+        Yield the pages that need exporting in chunks for the workers.  The pages are read a chunk at a time
+        by primary key, so no cursor is held open between chunks and only the values the workers need are
+        kept in memory
+        """
+        chunk = []
+        last_pk = None
+        while True:
+            pages = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:chunk_size])
+            if not pages:
+                break
+            last_pk = pages[-1].pk
+
+            for page in pages:
+                version = get_page_version(page)
+                if manifest.get(str(page.pk), None) == version:
+                    continue
+
+                chunk.append((page.pk, page.slug, version))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+
+        if chunk:
+            yield chunk
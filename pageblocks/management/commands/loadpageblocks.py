@@ -0,0 +1,134 @@
+import json
+import sys
+from functools import reduce
+from operator import or_
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils.text import slugify
+
+from ...blocks import BlockProcessor, ImageBlock
+from ...cache import snapshots_enabled
+from ...images import acquire_images
+from ...models import Image
+from .dumppageblocks import get_page_fields
+
+
+def read_batches(f, batch_size):
+    batch = []
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+
+        try:
+            batch.append(json.loads(line))
+        except ValueError as e:
+            raise CommandError('Line %d: %s' % (line_number, e))
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Command(BaseCommand):
+    help = 'Create pages, along with their blocks, from JSON Lines written by dumppageblocks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', nargs='?', default='-',
+                            help='File to read from.  Defaults to stdin')
+        parser.add_argument('--model', default='pageblocks.Page',
+                            help='The page model to load into, as app_label.ModelName')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of pages to create in each transaction')
+
+    def handle(self, input='-', model='pageblocks.Page', batch_size=100, **options):
+        try:
+            page_model = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        f = sys.stdin if input == '-' else open(input)
+        try:
+            count = 0
+            for batch in read_batches(f, batch_size):
+                with transaction.atomic():
+                    count += len(self.load_batch(page_model, batch))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        self.stdout.write('Loaded %d page(s)' % count)
+
+    def load_batch(self, page_model, batch):
+        block_model = page_model.blocks.rel.related_model
+        slugs = self.get_unique_slugs(page_model, [
+            slugify(page_data.get('slug', None) or page_data.get('title', {}).get(settings.LANGUAGE_CODE, '')) or 'untitled'
+            for page_data in batch
+        ])
+
+        fields = [field for field in get_page_fields(page_model) if field.name != 'slug']
+        pages = []
+        page_blocks = {}
+        for page_data, slug in zip(batch, slugs):
+            page = page_model(slug=slug, **{
+                field.attname: field.to_python(page_data[field.name]) for field in fields if field.name in page_data
+            })
+            pages.append(page)
+            page_blocks[page.pk] = self.get_page_blocks(block_model, page, page_data.get('blocks', []))
+
+        page_model.objects.bulk_create(pages)
+        block_model.objects.bulk_create([page_block for page in pages for page_block in page_blocks[page.pk]])
+
+        image_ids = [
+            image_id for blocks in page_blocks.values() for page_block in blocks
+            for image_id in ImageBlock.get_image_ids(page_block.data, page_block.i18n_data)
+        ]
+        if image_ids:
+            # Images aren't part of the dump, so only references to ones that already exist are counted
+            existing_ids = {str(image_id) for image_id in Image.objects.filter(id__in=image_ids).values_list('id', flat=True)}
+            acquire_images([image_id for image_id in image_ids if str(image_id) in existing_ids])
+
+        if snapshots_enabled():
+            processor = BlockProcessor()
+            for page in pages:
+                page.block_snapshot = processor.build_snapshot(page, page_blocks[page.pk])
+            page_model.objects.bulk_update(pages, ['block_snapshot'])
+
+        return pages
+
+    def get_page_blocks(self, block_model, page, nodes, parent=None):
+        """
+        Unsaved block instances for a page's tree, parents first so they can be created in one go
+        """
+        page_blocks = []
+        for index, node in enumerate(nodes):
+            page_block = block_model(page=page, parent=parent, index=index, type=node['type'],
+                                     data=node.get('data', {}), i18n_data=node.get('i18n_data', {}))
+            page_blocks.append(page_block)
+            page_blocks += self.get_page_blocks(block_model, page, node.get('blocks', []), page_block)
+        return page_blocks
+
+    def get_unique_slugs(self, page_model, slugs):
+        """
+        Make each slug unique, both among existing pages and within the batch, by adding a numeric suffix
+        the same way the admin does.  The slugs already taken are found with a single query
+        """
+        taken = set(page_model.objects.filter(
+            reduce(or_, [Q(slug__startswith=slug) for slug in set(slugs)])
+        ).values_list('slug', flat=True))
+
+        unique_slugs = []
+        for slug in slugs:
+            unique_slug = slug
+            offset = 0
+            while unique_slug in taken:
+                offset += 1
+                unique_slug = '%s_%d' % (slug, offset)
+            taken.add(unique_slug)
+            unique_slugs.append(unique_slug)
+        return unique_slugs
@@ -0,0 +1,39 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from ...blocks import BlockProcessor
+from ...cache import snapshots_enabled
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the block snapshot of every page, e.g. after changing the code or templates of a block type'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default='pageblocks.Page',
+                            help='The page model to rebuild, as app_label.ModelName')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of pages (and their blocks) to load at a time')
+
+    def handle(self, model='pageblocks.Page', batch_size=100, **options):
+        if not snapshots_enabled():
+            raise CommandError('Snapshots are disabled.  Set PAGEBLOCKS_SNAPSHOTS = True to use them')
+
+        try:
+            page_model = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+        processor = BlockProcessor()
+        count = 0
+        last_pk = None
+        while True:
+            queryset = page_model.objects.order_by('pk')
+            pages = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:batch_size])
+            if not pages:
+                break
+            last_pk = pages[-1].pk
+
+            processor.rebuild_snapshots(pages)
+            count += len(pages)
+
+        self.stdout.write('Rebuilt the snapshots of %d page(s)' % count)
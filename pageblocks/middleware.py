@@ -0,0 +1,59 @@
+import logging
+import time
+
+from django.conf import settings
+
+from .instrumentation import Collector, collect
+
+
+def get_slow_request_threshold():
+    return getattr(settings, 'PAGEBLOCKS_SLOW_REQUEST_THRESHOLD', 500)
+
+
+class ServerTimingMiddleware(object):
+    """
+    Measure the blocks rendered and saved during each request, reporting the totals in a Server-Timing
+    header.  Requests that take longer than PAGEBLOCKS_SLOW_REQUEST_THRESHOLD milliseconds are also logged
+    along with their slowest blocks.  Streaming responses render their blocks after the headers are sent,
+    so they don't get a header
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        with collect(Collector()) as collector:
+            response = self.get_response(request)
+        duration = (time.perf_counter() - start) * 1000
+
+        summary = collector.get_summary()
+        if summary and not response.streaming:
+            response['Server-Timing'] = self.get_server_timing(summary)
+
+        threshold = get_slow_request_threshold()
+        if threshold is not None and duration > threshold:
+            logging.warning('Slow request to %s took %.1fms: %s' % (
+                request.path, duration, self.describe(summary, collector.get_slowest_blocks())
+            ))
+
+        return response
+
+    def get_server_timing(self, summary):
+        return ', '.join(
+            'pageblocks-%s;dur=%.1f;desc="%d %s, %d queries"' % (
+                kind, totals['duration'], totals['count'], 'blocks' if kind == 'block' else 'calls', totals['queries']
+            ) for kind, totals in summary.items()
+        )
+
+    def describe(self, summary, slowest_blocks):
+        parts = [
+            '%s %.1fms (%d queries, %d cache hits, %d misses)' % (
+                kind, totals['duration'], totals['queries'], totals['cache_hits'], totals['cache_misses']
+            ) for kind, totals in summary.items()
+        ]
+        parts += [
+            '%s %s %.1fms (%d queries)' % (block['block_type'], block['block_id'], block['duration'], block['queries'])
+            for block in slowest_blocks
+        ]
+        return '; '.join(parts) if parts else 'no blocks rendered'
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pageblocks', '0005_remove_pageblock_language_pageblock_i18n_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='content_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pageblocks', '0007_page_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='block_snapshot',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:42
+
+from collections import Counter
+
+from django.db import migrations, models
+
+
+def count_image_references(apps, schema_editor):
+    PageBlock = apps.get_model('pageblocks', 'PageBlock')
+    Image = apps.get_model('pageblocks', 'Image')
+
+    references = Counter()
+    for data, i18n_data in PageBlock.objects.values_list('data', 'i18n_data').iterator():
+        for block_data in [data or {}] + list((i18n_data or {}).values()):
+            if isinstance(block_data, dict) and block_data.get('image_id', None):
+                references[str(block_data['image_id'])] += 1
+
+    for image_id, count in references.items():
+        Image.objects.filter(id=image_id).update(ref_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pageblocks', '0009_image_dimensions_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='ref_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_image_references, migrations.RunPython.noop),
+    ]
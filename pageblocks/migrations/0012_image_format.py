@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:13
+
+import os
+
+from django.db import migrations, models
+
+
+def set_image_formats(apps, schema_editor):
+    Image = apps.get_model('pageblocks', 'Image')
+
+    # The original's format is taken from its extension, and only kept if derivatives were made in it
+    for image_id, name, derivatives in Image.objects.values_list('id', 'image', 'derivatives').iterator():
+        extension = os.path.splitext(name or '')[1][1:].lower()
+        image_format = 'jpeg' if extension == 'jpg' else extension
+        if image_format and image_format in (derivatives or {}):
+            Image.objects.filter(id=image_id).update(image_format=image_format)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pageblocks', '0011_image_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='image_format',
+            field=models.CharField(blank=True, editable=False, max_length=10),
+        ),
+        migrations.RunPython(set_image_formats, migrations.RunPython.noop),
+    ]
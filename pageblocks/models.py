@@ -1,11 +1,11 @@
 import uuid
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.utils.translation import get_language, gettext
 
-from .utils import class_from_name
-from . import PAGEBLOCKS_DEFAULT_AVAILABLE
+from .registry import get_available_block_types, registry
 
 
 class MultiLanguageField(models.JSONField):
@@ -23,6 +23,9 @@ class AbstractPage(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     slug = models.SlugField(unique=True, null=False, blank=False)
     title = MultiLanguageField()
+    content_version = models.PositiveIntegerField(default=0, editable=False)
+    modified = models.DateTimeField(auto_now=True)
+    block_snapshot = models.JSONField(null=True, blank=True, editable=False)
 
     class Meta:
         abstract = True
@@ -30,17 +33,22 @@ class AbstractPage(models.Model):
     def __str__(self):
         return self.title.get(get_language(), gettext('Untitled'))
 
+    def bump_content_version(self):
+        """
+        Mark the page's block content as changed, which invalidates any cached renders of it
+        """
+        type(self).objects.filter(pk=self.pk).update(content_version=models.F('content_version') + 1,
+                                                     modified=timezone.now())
+        self.refresh_from_db(fields=['content_version', 'modified'])
+
     @classmethod
     def get_available_block_type_classes(cls):
-        try:
-            return settings.PAGEBLOCKS_AVAILABLE_BLOCKS
-        except AttributeError:
-            return PAGEBLOCKS_DEFAULT_AVAILABLE
+        return get_available_block_types()
 
     @classmethod
     def get_available_blocks(cls):
         return [
-            (c, class_from_name(c)) for c in cls.get_available_block_type_classes()
+            (c, registry.get_block_class(c)) for c in cls.get_available_block_type_classes()
         ]
 
     def get_blocks(self):
@@ -62,8 +70,17 @@ class AbstractPageBlock(models.Model):
         abstract = True
         ordering = ['index']
 
+    def get_children(self):
+        """
+        Child blocks ordered by index.  When the page's block tree has been preloaded (see
+        BlockProcessor.load_tree) this is served from memory rather than the database
+        """
+        if hasattr(self, '_tree_children'):
+            return self._tree_children
+        return self.children.all().order_by('index')
+
     def get_block(self):
-        return class_from_name(self.type)(data={
+        return registry.get_block_class(self.type)(data={
             'data': self.data,
             'i18n_data': self.i18n_data,
             'type': self.type,
@@ -77,3 +94,31 @@ class PageBlock(AbstractPageBlock):
 class Image(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     image = models.ImageField(upload_to='pageblocks/%Y/%m/%d/')
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    image_format = models.CharField(max_length=10, blank=True, editable=False)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    ref_count = models.PositiveIntegerField(default=0, editable=False)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    def save(self, *args, **kwargs):
+        from .images import delete_derivatives, get_derivatives_mode, schedule_derivatives
+
+        file_changed = self.image and not self.image._committed
+        if file_changed:
+            self.width, self.height = self.image.width, self.image.height
+            delete_derivatives(self)
+            self.derivatives = {}
+            self.image_format = ''
+
+        super().save(*args, **kwargs)
+
+        if file_changed and get_derivatives_mode() == 'background':
+            transaction.on_commit(lambda: schedule_derivatives(self.pk))
+
+    def delete(self, *args, **kwargs):
+        from .images import delete_derivatives
+
+        delete_derivatives(self)
+        return super().delete(*args, **kwargs)
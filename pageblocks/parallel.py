@@ -0,0 +1,98 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import translation
+from django.utils.translation import get_language
+
+from .instrumentation import measure_block
+
+_executor = None
+_executor_lock = threading.Lock()
+_worker_state = threading.local()
+_timed_out = contextvars.ContextVar('pageblocks_timed_out', default=None)
+
+
+def get_render_timeout(block):
+    """
+    How long (in seconds) to wait for a parallel block before giving up on it, or None to wait forever
+    """
+    if block.render_timeout is not None:
+        return block.render_timeout
+    return getattr(settings, 'PAGEBLOCKS_RENDER_TIMEOUT', None)
+
+
+def get_render_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PAGEBLOCKS_RENDER_WORKERS', 4),
+                                           thread_name_prefix='pageblocks-render')
+        return _executor
+
+
+def is_render_worker():
+    return getattr(_worker_state, 'active', False)
+
+
+def submit_render(block):
+    """
+    Start rendering a block on the render pool, returning a (future, deadline) pair for get_rendered()
+    """
+    timeout = get_render_timeout(block)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    # Each block gets its own copy of the context so the active language, collector etc. carry over
+    context = contextvars.copy_context()
+    return get_render_executor().submit(context.run, render_in_worker, block, get_language()), deadline
+
+
+def render_in_worker(block, language):
+    _worker_state.active = True
+    try:
+        with translation.override(language):
+            return measure_block(block, block.render)
+    finally:
+        _worker_state.active = False
+        # The pool's threads are long lived, so their connections are kept (subject to CONN_MAX_AGE) the same
+        # way Django keeps them between requests
+        close_old_connections()
+
+
+def may_time_out(block):
+    return block.parallel_safe and get_render_timeout(block) is not None
+
+
+@contextmanager
+def track_timeouts():
+    """
+    Collect the blocks that time out while the wrapped code renders, so output that fell back to their
+    placeholders isn't cached
+    """
+    timed_out = []
+    token = _timed_out.set(timed_out)
+    try:
+        yield timed_out
+    finally:
+        _timed_out.reset(token)
+
+
+def get_rendered(block, future, deadline):
+    """
+    The output of a block started with submit_render(), or its placeholder if it missed its deadline
+    """
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()) if deadline is not None else None)
+    except TimeoutError:
+        future.cancel()
+        logging.warning('Rendering block %s (%s) timed out' % (
+            block.instance.id if block.instance is not None else None, block.block_type
+        ))
+        timed_out = _timed_out.get()
+        if timed_out is not None:
+            timed_out.append(block)
+        return block.render_placeholder()
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.template.loader import get_template
+from django.utils.autoreload import file_changed
+from django.utils.translation import get_language
+
+from .utils import class_from_name
+from . import PAGEBLOCKS_DEFAULT_AVAILABLE
+
+
+def get_available_block_types():
+    try:
+        return settings.PAGEBLOCKS_AVAILABLE_BLOCKS
+    except AttributeError:
+        return PAGEBLOCKS_DEFAULT_AVAILABLE
+
+
+class BlockRegistry(object):
+    """
+    Maps block type strings to their classes.  The available block types are resolved once when the app
+    is ready, so looking up a block class on the hot path is just a dictionary lookup
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.block_classes = {}
+        self.field_definitions = {}
+        self.block_definitions = {}
+        self.validators = {}
+        self.reset_templates()
+
+    def reset_templates(self):
+        self.templates = {}
+
+    def populate(self):
+        """
+        Import every available block type.  Any that fail to import are left out here and reported
+        by the system checks instead
+        """
+        for block_type in get_available_block_types():
+            try:
+                self.get_block_class(block_type)
+            except (ImportError, AttributeError, ValueError) as e:
+                logging.error('Unable to load block type %s: %s' % (block_type, e))
+
+    def get_block_class(self, block_type):
+        try:
+            return self.block_classes[block_type]
+        except KeyError:
+            # Block types that aren't in the available list (e.g. ones only used within a
+            # BlockStreamField) are imported the first time they're needed
+            block_class = class_from_name(block_type)
+            self.block_classes[block_type] = block_class
+            return block_class
+
+    def get_field_definitions(self, block_type):
+        """
+        The serialized field definitions for a block type.  Labels are translated, so these are cached per
+        language
+        """
+        key = (block_type, get_language())
+        if key not in self.field_definitions:
+            self.field_definitions[key] = self.get_block_class(block_type).serialize_field_definitions()
+        return self.field_definitions[key]
+
+    def get_validator(self, block_type):
+        """
+        The compiled validator for a block type (see blocks.BlockValidator)
+        """
+        try:
+            return self.validators[block_type]
+        except KeyError:
+            from .blocks import BlockValidator
+
+            validator = BlockValidator(self.get_block_class(block_type))
+            self.validators[block_type] = validator
+            return validator
+
+    def get_block_definitions(self, block_types):
+        """
+        The editor's definitions for a list of block types as JSON, along with a fingerprint of that JSON.
+        These are cached per language
+        """
+        key = (tuple(block_types), get_language())
+        if key not in self.block_definitions:
+            content = json.dumps({
+                block_type: {
+                    'name': str(self.get_block_class(block_type).name),
+                    'description': str(self.get_block_class(block_type).description),
+                    'fields': self.get_field_definitions(block_type)
+                } for block_type in block_types
+            })
+            self.block_definitions[key] = (content, hashlib.sha256(content.encode()).hexdigest()[:16])
+        return self.block_definitions[key]
+
+    def get_template(self, template_name):
+        """
+        The compiled template for a block, loaded once and reused.  Templates aren't held on to in DEBUG
+        so that changes show up straight away
+        """
+        if settings.DEBUG:
+            return get_template(template_name)
+
+        if template_name not in self.templates:
+            self.templates[template_name] = get_template(template_name)
+        return self.templates[template_name]
+
+
+registry = BlockRegistry()
+
+
+def reset_registry(setting, **kwargs):
+    if setting in ('PAGEBLOCKS_AVAILABLE_BLOCKS', 'LANGUAGES'):
+        registry.reset()
+    elif setting in ('TEMPLATES', 'DEBUG'):
+        registry.reset_templates()
+
+
+def reset_registry_templates(sender, file_path, **kwargs):
+    registry.reset_templates()
+
+
+setting_changed.connect(reset_registry)
+file_changed.connect(reset_registry_templates)
@@ -0,0 +1,11 @@
+from django.dispatch import Signal
+
+# Sent after each block is rendered, with block_type, block_id, duration (in milliseconds), queries and cache
+# ('hit', 'miss' or None if the block wasn't cached).  Container timings include their nested blocks
+block_rendered = Signal()
+
+# Sent after BlockProcessor.render, with the number of blocks, duration and queries
+blocks_rendered = Signal()
+
+# Sent after BlockProcessor.save, with the page, the number of blocks, duration and queries
+blocks_saved = Signal()
@@ -65,7 +65,7 @@ window.addEventListener('load', () => {
         <div class="selector" v-if="!image" v-on:click.prevent="$refs.newImage.click()">
           <span>{{ getText('labelBtnAdd') }}</span>
         </div>
-        <img v-if="image" :src="image" v-on:click.prevent="$refs.newImage.click()"/>
+        <img v-if="image" :src="getImageUrl()" v-on:click.prevent="$refs.newImage.click()"/>
         <input v-on:change="handleImage" ref="newImage" class="new-image-btn" type="file" accept="image/*" style="display: none;"/>
       </div>
     `,
@@ -81,12 +81,46 @@ window.addEventListener('load', () => {
     },
     methods: {
       handleImage(e) {
-        this.readImage(e.target.files[0]).then((img) => {
+        const uploadUrl = this.getUploadUrl();
+        const request = uploadUrl ? this.uploadImage(uploadUrl, e.target.files[0]) : this.readImage(e.target.files[0]);
+        request.then((img) => {
           this.image = img;
           this.$emit('input', this.image);
           this.$emit('change', this.image);
         });
       },
+      getImageUrl() {
+        return this.image && typeof this.image === 'object' ? this.image.url : this.image;
+      },
+      getUploadUrl() {
+        let c = this;
+        while (c) {
+          if (c.uploadUrl) {
+            return c.uploadUrl;
+          }
+          c = c.$parent ? c.$parent : null;
+        }
+        return null;
+      },
+      uploadImage(uploadUrl, fileObject) {
+        /* Upload the file on its own so it's streamed to storage, and reference it by id in the block data */
+        const formData = new FormData();
+        formData.append('image', fileObject);
+        const csrfInput = document.querySelector('input[name="csrfmiddlewaretoken"]');
+        return fetch(uploadUrl, {
+          method: 'POST',
+          body: formData,
+          credentials: 'same-origin',
+          headers: csrfInput ? {'X-CSRFToken': csrfInput.value} : {}
+        }).then((response) => {
+          if (!response.ok) {
+            throw new Error('Image upload failed');
+          }
+          return response.json();
+        }).then((data) => {
+          return {id: data.id, url: data.url};
+        });
+      },
       readImage(fileObject) {
         return new Promise((resolve) => {
           const reader = new FileReader();
@@ -351,20 +385,22 @@ window.addEventListener('load', () => {
       <input type="hidden" :name="name" v-model="jsonValue" />
 
       <block-editor
+        v-if="blockDefinitions"
         v-model="blocks"
-        :available-blocks="availableBlocks"
+        :available-blocks="blockDefinitions"
         v-on:change="onFieldChanged()"
         :input-name="name"
         :languages="languages"
         :default-language="defaultLanguage"></block-editor>
 
     </div>`,
-    props: ['languages', 'initialValue', 'availableBlocks', 'name', 'defaultLanguage'],
+    props: ['languages', 'initialValue', 'availableBlocks', 'availableBlocksUrl', 'name', 'defaultLanguage', 'uploadUrl'],
     mixins: [FlagLookupMixin, TranslateMixin],
     data: function() {
       return {
         jsonValue: '[]',
-        blocks: {}
+        blocks: {},
+        blockDefinitions: null
       };
     },
     created: function() {
@@ -374,7 +410,19 @@ window.addEventListener('load', () => {
         this.blocks[language] = [];
       }
 
-      this.availableBlocks = JSON.parse(atob(this.availableBlocks));
+      if (this.availableBlocksUrl) {
+        /* The definitions are served separately so the browser can cache them between page loads */
+        fetch(this.availableBlocksUrl, {credentials: 'same-origin'}).then((response) => {
+          if (!response.ok) {
+            throw new Error('Unable to load block definitions');
+          }
+          return response.json();
+        }).then((data) => {
+          this.blockDefinitions = data;
+        });
+      } else {
+        this.blockDefinitions = JSON.parse(atob(this.availableBlocks));
+      }
       if (this.initialValue) {
         this.jsonValue = this.initialValue;
       }
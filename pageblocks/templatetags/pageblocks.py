@@ -3,7 +3,7 @@ from django.conf import settings
 from django.utils.translation import get_language
 from django.utils.safestring import mark_safe
 
-from ..blocks import BlockProcessor
+from ..blocks import BlockProcessor, RenderResult
 
 register = template.Library()
 
@@ -14,6 +14,9 @@ def multilang(val):
 
 @register.simple_tag
 def blocks(page_blocks):
+    if isinstance(page_blocks, RenderResult):
+        # Already rendered, e.g. by ContainerBlock.arender
+        return page_blocks.html
     return mark_safe(BlockProcessor().render(page_blocks))
 
 @register.simple_tag
@@ -25,16 +28,34 @@ def block_stylesheets(page_blocks):
     return mark_safe(BlockProcessor().render_stylesheet_tags(page_blocks))
 
 def get_blocks_for_page(page):
-    return page.get_blocks()
+    return BlockProcessor().load_tree(page)
+
+@register.simple_tag
+def pageblocks_render(page):
+    """
+    The full render result for a page, e.g. {% pageblocks_render page as result %} makes result.html,
+    result.script_tags and result.stylesheet_tags available
+    """
+    return BlockProcessor().render_page(page)
 
 @register.simple_tag
 def pageblocks(page):
-    return blocks(get_blocks_for_page(page))
+    if is_streaming(page):
+        # The blocks are streamed in place of the marker (see PageView.streaming)
+        return mark_safe(page._pageblocks_stream_marker)
+    return pageblocks_render(page).html
 
 @register.simple_tag
 def pageblocks_scripts(page):
-    return block_scripts(get_blocks_for_page(page))
+    if is_streaming(page):
+        return block_scripts(BlockProcessor().get_page_blocks(page))
+    return pageblocks_render(page).script_tags
 
 @register.simple_tag
 def pageblocks_stylesheets(page):
-    return block_stylesheets(get_blocks_for_page(page))
+    if is_streaming(page):
+        return block_stylesheets(BlockProcessor().get_page_blocks(page))
+    return pageblocks_render(page).stylesheet_tags
+
+def is_streaming(page):
+    return getattr(page, '_pageblocks_stream_marker', None) is not None
@@ -1,13 +1,122 @@
+import asyncio
 import json
+import time
+import os
+import tempfile
+import uuid
+from io import BytesIO, StringIO
+from unittest import mock
 
-from django.test import TestCase, override_settings
-from django.utils.translation import gettext_lazy, override as translation_override
+from asgiref.sync import sync_to_async
+from django.contrib.admin import AdminSite
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.db import connection, connections
+from django.template.loader import get_template
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.translation import get_language, gettext_lazy, override as translation_override
+from PIL import Image as PILImage
 
-from .models import Page, PageBlock
+from .admin import PageAdmin
+from .models import Image, Page, PageBlock
 from .forms import PageAdminForm
+from .images import delete_images, generate_derivatives, store_image
+from .blocks import BlockProcessor
+from .blocks import BlockStreamField, BlockValidationError, ContainerBlock, HTMLBlock
+from .checks import check_block_types
+from .registry import registry
+from .views import AsyncPageView, PageView
+from .instrumentation import collect
+from .middleware import ServerTimingMiddleware
+from .signals import block_rendered
+from .templatetags.pageblocks import pageblocks, pageblocks_scripts, pageblocks_stylesheets
 
 from . import PAGEBLOCKS_DEFAULT_AVAILABLE
 
+class ScriptedHTMLBlock(HTMLBlock):
+    def get_scripts(self, *args, **kwargs):
+        return ['/static/%s.js' % self.data.get('script', 'common'), '/static/common.js']
+
+    def get_stylesheets(self, *args, **kwargs):
+        return ['/static/common.css']
+
+
+class SlowHTMLBlock(HTMLBlock):
+    async def arender(self):
+        await asyncio.sleep(0.2)
+        return await super().arender()
+
+
+class ParallelHTMLBlock(HTMLBlock):
+    parallel_safe = True
+
+    def get_render_context_data(self, *args, **kwargs):
+        time.sleep(self.data.get('delay', 0.2))
+        ctx = super().get_render_context_data(*args, **kwargs)
+        ctx['block']['html'] = '%s:%s' % (ctx['block']['html'], get_language())
+        return ctx
+
+    def render_placeholder(self):
+        return '<!-- timed out -->'
+
+
+class QueryingHTMLBlock(HTMLBlock):
+    def get_render_context_data(self, *args, **kwargs):
+        ctx = super().get_render_context_data(*args, **kwargs)
+        ctx['block']['html'] = '%s:%d' % (ctx['block']['html'], Page.objects.count())
+        return ctx
+
+    def get_scripts(self, *args, **kwargs):
+        return ['/static/%s.js' % Page.objects.get(pk=self.instance.page_id).slug]
+
+
+class SlowOnceHTMLBlock(ParallelHTMLBlock):
+    calls = 0
+
+    def get_render_context_data(self, *args, **kwargs):
+        type(self).calls += 1
+        self.data['delay'] = 0.5 if type(self).calls == 1 else 0
+        return super().get_render_context_data(*args, **kwargs)
+
+
+class RowBlock(ContainerBlock):
+    fields = (
+        ('blocks', BlockStreamField(label='Blocks', required=True, block_types=[HTMLBlock])),
+    )
+
+
+class LabelledContainerBlock(ContainerBlock):
+    def save(self, *args, **kwargs):
+        self.data['class'] = 'labelled'
+        return super().save(*args, **kwargs)
+
+
+class UppercaseHTMLBlock(HTMLBlock):
+    def clean(self, *args, **kwargs):
+        data = super().clean(*args, **kwargs)
+        if data['html'] == 'invalid':
+            raise BlockValidationError('Not allowed', field_id='html')
+        return dict(data, html=data['html'].upper())
+
+
+class ExclaimingHTMLBlock(HTMLBlock):
+    def clean(self, *args, **kwargs):
+        data = super().clean(*args, **kwargs)
+        return dict(data, html=data['html'] + '!')
+
+
+class CheckedContainerBlock(ContainerBlock):
+    def clean(self, *args, **kwargs):
+        data = super().clean(*args, **kwargs)
+        return dict(data, checked=True)
+
+
 class AvailableBlockTestCase(TestCase):
     """
     Test logic to get available block types, with and without overridden settings
@@ -21,6 +130,46 @@ class AvailableBlockTestCase(TestCase):
             'pageblocks.blocks.RawHTMLBlock'
         ])
 
+    @override_settings(PAGEBLOCKS_AVAILABLE_BLOCKS=[
+        'pageblocks.blocks.HTMLBlock',
+        'pageblocks.blocks.RawHTMLBlock',
+        'pageblocks.models.Page',
+    ])
+    def test_misconfigured_block_types_fail_checks(self):
+        errors = check_block_types(None)
+        self.assertEqual([error.id for error in errors], ['pageblocks.E001', 'pageblocks.E002'])
+
+    def test_registry_lookup_does_not_import(self):
+        registry.populate()
+        with mock.patch('importlib.import_module') as import_mock:
+            for block_type in PAGEBLOCKS_DEFAULT_AVAILABLE:
+                self.assertEqual(registry.get_block_class(block_type).__name__, block_type.rsplit('.', 1)[1])
+        import_mock.assert_not_called()
+
+    def test_block_definitions_endpoint(self):
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        page_admin = PageAdmin(Page, AdminSite())
+        with translation_override('en'):
+            content, fingerprint = registry.get_block_definitions(Page.get_available_block_type_classes())
+            with mock.patch.object(registry, 'get_field_definitions') as definitions_mock:
+                self.assertEqual(registry.get_block_definitions(Page.get_available_block_type_classes()),
+                                 (content, fingerprint))
+            definitions_mock.assert_not_called()
+
+            request = RequestFactory().get('/')
+            request.user = user
+            response = page_admin.block_definitions_view(request, fingerprint)
+            self.assertEqual(json.loads(response.content)['pageblocks.blocks.HTMLBlock']['name'], 'HTML')
+            self.assertIn('immutable', response['Cache-Control'])
+            self.assertIn('no-cache', page_admin.block_definitions_view(request, 'stale')['Cache-Control'])
+
+        widget = PageAdminForm().fields['blocks'].widget
+        self.assertIn('available-blocks=', widget.render('blocks', '[]'))
+        widget.blocks_url = '/admin/pageblocks/page/block-definitions/%s.json' % fingerprint
+        html = widget.render('blocks', '[]')
+        self.assertIn('available-blocks-url="%s"' % widget.blocks_url, html)
+        self.assertNotIn('available-blocks=', html)
+
 
 @override_settings(LANGUAGES=[
     ('es', gettext_lazy('Spanish')),
@@ -162,6 +311,63 @@ class PageEditingTestCase(TestCase):
             self.assertFalse(form.is_valid(), 'Form validated when it shouldn\'t have')
             self.assertEqual(form.errors['blocks'].as_text(), '* B:0:html:This field is required')
 
+    def test_clean_reports_every_error(self):
+        data = [
+            {'type': 'pageblocks.blocks.HTMLBlock', 'data': {}, 'i18n_data': {}},
+            {'type': 'pageblocks.tests.RowBlock', 'data': {'blocks': [
+                {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': 5}, 'i18n_data': {}},
+                {'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': 'http://example.com/a.png'}, 'i18n_data': {}},
+                {'type': 'pageblocks.blocks.ContainerBlock', 'data': {'blocks': []}, 'i18n_data': {}},
+            ]}, 'i18n_data': {}},
+            {'type': 'pageblocks.blocks.ContainerBlock', 'data': {'blocks': [
+                {'type': 'pageblocks.tests.UppercaseHTMLBlock', 'data': {'html': 'invalid'}, 'i18n_data': {}},
+                {'type': 'pageblocks.tests.UppercaseHTMLBlock', 'data': {'html': 'shout'}, 'i18n_data': {}},
+                {'type': 'pageblocks.blocks.MissingBlock', 'data': {}, 'i18n_data': {}},
+            ]}, 'i18n_data': {}},
+        ]
+
+        with translation_override('en'), self.assertRaises(ValidationError) as cm:
+            BlockProcessor().clean(data)
+        self.assertEqual(cm.exception.messages, [
+            'B:0:html:This field is required',
+            'B:1,0:html:Invalid value',
+            'B:1,1:type:This block type isn\'t allowed here',
+            'B:1,2:type:This block type isn\'t allowed here',
+            'B:2,0:html:Not allowed',
+            'B:2,2:type:Unknown block type',
+        ])
+        self.assertEqual(data[2]['data']['blocks'][1]['data']['html'], 'SHOUT')
+
+    def test_clean_with_custom_container_clean(self):
+        data = [
+            {'type': 'pageblocks.tests.CheckedContainerBlock', 'data': {'blocks': [
+                {'type': 'pageblocks.tests.ExclaimingHTMLBlock', 'data': {'html': 'a'}, 'i18n_data': {}},
+                {'type': 'pageblocks.blocks.ContainerBlock', 'data': {'blocks': [
+                    {'type': 'pageblocks.tests.ExclaimingHTMLBlock', 'data': {'html': 'b'}, 'i18n_data': {}},
+                ]}, 'i18n_data': {}},
+            ]}, 'i18n_data': {}},
+        ]
+        BlockProcessor().clean(data)
+        self.assertTrue(data[0]['data']['checked'])
+        self.assertEqual(data[0]['data']['blocks'][0]['data']['html'], 'a!')
+        self.assertEqual(data[0]['data']['blocks'][1]['data']['blocks'][0]['data']['html'], 'b!')
+
+        data = [
+            {'type': 'pageblocks.blocks.HTMLBlock', 'data': {}, 'i18n_data': {}},
+            {'type': 'pageblocks.tests.CheckedContainerBlock', 'data': {'blocks': [
+                {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>Fine</b>'}, 'i18n_data': {}},
+                {'type': 'pageblocks.tests.UppercaseHTMLBlock', 'data': {'html': 'invalid'}, 'i18n_data': {}},
+                {'type': 'pageblocks.blocks.HTMLBlock', 'data': {}, 'i18n_data': {}},
+            ]}, 'i18n_data': {}},
+        ]
+        with translation_override('en'), self.assertRaises(ValidationError) as cm:
+            BlockProcessor().clean(data)
+        self.assertEqual(cm.exception.messages, [
+            'B:0:html:This field is required',
+            'B:1,1:html:Not allowed',
+            'B:1,2:html:This field is required',
+        ])
+
     def test_create_page_with_nested_blocks(self):
         """ ContainerBlocks are special block types which allow other blocks to be embedded within them """
 
@@ -201,4 +407,824 @@ class PageEditingTestCase(TestCase):
         self.assertEqual(page.blocks.exclude(parent=None)[0].data['html'], '<b>This is a sub block</b>')
         self.assertEqual(page.blocks.exclude(parent=None)[0].i18n_data['es']['html'], '<b>Este es un sub bloque</b>')
 
-    # TODO: Test creating a page with a required block field (or type) missing
\ No newline at end of file
+    def test_container_with_custom_save(self):
+        page = Page.objects.create(slug='custom_save_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {"type": "pageblocks.tests.LabelledContainerBlock", "data": {"class": "row", "blocks": [
+                {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<b>Child</b>"}, "i18n_data": {}},
+            ]}},
+        ])
+
+        container = page.blocks.get(parent=None)
+        self.assertEqual(container.data, {'class': 'labelled'})
+        self.assertEqual([block.data['html'] for block in container.children.all()], ['<b>Child</b>'])
+
+        edit_data = BlockProcessor().blocks_to_representation(page.blocks.filter(parent=None))
+        edit_data[0]['data']['blocks'][0]['data']['html'] = '<b>Changed</b>'
+        BlockProcessor().save(page, edit_data)
+        self.assertEqual([block.data['html'] for block in page.blocks.exclude(parent=None)], ['<b>Changed</b>'])
+        self.assertEqual(page.blocks.count(), 2)
+
+    def test_editor_representation_uses_one_query(self):
+        blocks = [{"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<b>Leaf</b>"}, "i18n_data": {"es": {"html": "<b>Hoja</b>"}}}]
+        for level in range(4):
+            blocks = [
+                {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<i>%d</i>" % level}, "i18n_data": {}},
+                {"type": "pageblocks.blocks.ContainerBlock", "data": {"class": "level-%d" % level, "blocks": blocks}},
+            ]
+        page = Page.objects.create(slug='nested_edit_page', title={'en': 'test'})
+        BlockProcessor().save(page, blocks)
+
+        with self.assertNumQueries(1):
+            form = PageAdminForm(instance=page)
+        self.assertEqual(form.fields['blocks'].initial,
+                         BlockProcessor().blocks_to_representation(page.blocks.filter(parent=None)))
+        leaf = form.fields['blocks'].initial[1]['data']['blocks'][1]['data']['blocks'][1]['data']['blocks'][1]['data']['blocks'][0]
+        self.assertEqual(leaf['i18n_data'], {'es': {'html': '<b>Hoja</b>'}})
+
+    def test_save_query_count_independent_of_block_count(self):
+        buffer = BytesIO()
+        PILImage.new('RGB', (4, 4), 'red').save(buffer, format='PNG')
+        with tempfile.TemporaryDirectory() as media_root, self.settings(MEDIA_ROOT=media_root):
+            image = store_image(ContentFile(buffer.getvalue(), name='shared.png'))
+
+        def nested_blocks(width):
+            return [
+                {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<b>%d</b>" % i}, "i18n_data": {}}
+                for i in range(width)
+            ] + [
+                {"type": "pageblocks.blocks.ImageBlock", "data": {"image": {"id": str(image.id)}}, "i18n_data": {}}
+                for i in range(width)
+            ] + [
+                {"type": "pageblocks.blocks.ImageBlock", "data": {"image": {"id": str(uuid.uuid4())}}, "i18n_data": {}}
+            ] + [
+                {"type": "pageblocks.blocks.ContainerBlock", "data": {"class": "row", "blocks": [
+                    {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<i>%d</i>" % i}, "i18n_data": {}}
+                    for i in range(width)
+                ]}}
+            ]
+
+        query_counts = []
+        for width in (5, 40):
+            page = Page.objects.create(slug='bulk_page_%d' % width, title={'en': 'test'})
+            with CaptureQueriesContext(connection) as create_queries:
+                BlockProcessor().save(page, nested_blocks(width))
+
+            edit_data = BlockProcessor().blocks_to_representation(page.blocks.filter(parent=None))
+            edit_data[0]['data']['html'] = '<b>Changed</b>'
+            del edit_data[1]
+            with CaptureQueriesContext(connection) as edit_queries:
+                BlockProcessor().save(page, edit_data)
+
+            edit_data = BlockProcessor().blocks_to_representation(BlockProcessor().load_tree(page, use_snapshot=False))
+            with CaptureQueriesContext(connection) as unchanged_queries:
+                BlockProcessor().save(page, edit_data)
+
+            query_counts.append((len(create_queries), len(edit_queries), len(unchanged_queries)))
+            self.assertEqual(page.blocks.count(), width * 3 + 1)
+            self.assertIsNone(page.blocks.filter(type='pageblocks.blocks.ImageBlock').last().data['image_id'])
+            self.assertEqual(page.blocks.get(index=0, parent=None).data['html'], '<b>Changed</b>')
+
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(Image.objects.get(pk=image.pk).ref_count, 5 + 40)
+
+    def test_dump_and_load_pages(self):
+        page = Page.objects.create(slug='dumped_page', title={'en': 'Dumped', 'es': 'Volcado'})
+        BlockProcessor().save(page, [
+            {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<b>Top</b>"}, "i18n_data": {"es": {"html": "<b>Arriba</b>"}}},
+            {"type": "pageblocks.blocks.ContainerBlock", "data": {"class": "row", "blocks": [
+                {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<i>Nested</i>"}, "i18n_data": {}},
+            ]}},
+        ])
+        Page.objects.create(slug='dumped_page_1', title={'en': 'Taken'})
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'pages.jsonl')
+            call_command('dumppageblocks', path, chunk_size=1, stderr=StringIO())
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(len(lines), 2)
+            out = StringIO()
+            call_command('dumppageblocks', stdout=out, stderr=StringIO())
+            self.assertEqual([json.loads(line) for line in out.getvalue().splitlines()], lines)
+            self.assertEqual(sorted(lines[0].keys()), ['blocks', 'slug', 'title'])
+
+            with self.assertNumQueries(5):
+                call_command('loadpageblocks', path, stdout=StringIO())
+
+        loaded = Page.objects.get(slug='dumped_page_2')
+        self.assertEqual(Page.objects.filter(slug='dumped_page_1_1').count(), 1)
+        self.assertEqual(loaded.title, page.title)
+        self.assertEqual(BlockProcessor().blocks_to_representation(loaded.blocks.filter(parent=None))[1]['data']['blocks'][0]['data'],
+                         {'html': '<i>Nested</i>'})
+        self.assertEqual(loaded.blocks.get(index=0, parent=None).i18n_data, {'es': {'html': '<b>Arriba</b>'}})
+
+    def test_save_is_atomic(self):
+        page = Page.objects.create(slug='atomic_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<b>Original</b>"}, "i18n_data": {}}
+        ])
+
+        with mock.patch.object(Page, 'bump_content_version', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                BlockProcessor().save(page, [
+                    {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<b>Replacement</b>"}, "i18n_data": {}}
+                ])
+
+        self.assertEqual([block.data['html'] for block in page.blocks.all()], ['<b>Original</b>'])
+
+    # TODO: Test creating a page with a required block field (or type) missing
+
+@override_settings(LANGUAGES=[
+    ('es', gettext_lazy('Spanish')),
+    ('en', gettext_lazy('English')),
+], LANGUAGE_CODE='en')
+class PageRenderingTestCase(TestCase):
+    def create_nested_page(self, depth=3):
+        blocks = [{"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<b>Leaf</b>"}, "i18n_data": {}}]
+        for level in range(depth):
+            blocks = [
+                {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<i>%d</i>" % level}, "i18n_data": {}},
+                {"type": "pageblocks.blocks.ContainerBlock", "data": {"class": "level-%d" % level, "blocks": blocks}},
+            ]
+
+        form = PageAdminForm(data={
+            'slug': 'nested_page',
+            'title': {"es": "prueba", "en": "test"},
+            'blocks': blocks
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+        with translation_override('en'):
+            return form.save()
+
+    def test_load_tree(self):
+        page = self.create_nested_page()
+
+        with self.assertNumQueries(1):
+            roots = BlockProcessor().load_tree(page)
+            flattened = BlockProcessor().flatten_blocks(roots)
+
+        self.assertEqual([block.index for block in roots], [0, 1])
+        self.assertEqual(len(flattened), page.blocks.count())
+
+    def test_merged_data_only_for_active_language(self):
+        page_block = PageBlock(type='pageblocks.blocks.HTMLBlock', data={'html': '<b>Hello</b>'},
+                               i18n_data={'es': {'html': '<b>Hola</b>'}, 'fr': {'html': '<b>Bonjour</b>'}})
+        block = page_block.get_block()
+
+        with mock.patch.object(HTMLBlock, 'data_to_representation', autospec=True,
+                               side_effect=lambda self, data=None, language=None: dict(self.data if data is None else data)) as representation_mock:
+            self.assertEqual(block.get_merged_data('es'), {'html': '<b>Hola</b>'})
+            self.assertEqual(block.get_merged_data('es'), {'html': '<b>Hola</b>'})
+            self.assertEqual(page_block.get_block().get_merged_data('en'), {'html': '<b>Hello</b>'})
+
+        self.assertEqual([call.kwargs.get('language', None) for call in representation_mock.call_args_list], [None, 'es', None])
+
+    def test_parallel_rendering(self):
+        page = Page.objects.create(slug='parallel_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {"type": "pageblocks.tests.ParallelHTMLBlock", "data": {"html": "first"}, "i18n_data": {}},
+            {"type": "pageblocks.blocks.HTMLBlock", "data": {"html": "<b>Sequential</b>"}, "i18n_data": {}},
+            {"type": "pageblocks.blocks.ContainerBlock", "data": {"class": "row", "blocks": [
+                {"type": "pageblocks.tests.ParallelHTMLBlock", "data": {"html": "nested"}, "i18n_data": {}},
+            ]}},
+            {"type": "pageblocks.tests.ParallelHTMLBlock", "data": {"html": "slow", "delay": 1}, "i18n_data": {}},
+            {"type": "pageblocks.tests.ParallelHTMLBlock", "data": {"html": "last"}, "i18n_data": {}},
+        ])
+
+        with translation_override('es'), self.settings(PAGEBLOCKS_RENDER_TIMEOUT=0.5), self.assertLogs(level='WARNING'), \
+                mock.patch.object(connections, 'close_all') as close_mock:
+            start = time.perf_counter()
+            html = pageblocks(page)
+            self.assertLess(time.perf_counter() - start, 0.9)
+        # The render threads keep their connections between blocks
+        close_mock.assert_not_called()
+
+        self.assertEqual(html, 'first:es<b>Sequential</b><div class="row">nested:es</div><!-- timed out -->last:es')
+
+    def test_render_query_count_independent_of_depth(self):
+        page = self.create_nested_page(depth=5)
+
+        with translation_override('en'), self.assertNumQueries(1):
+            html = pageblocks(page)
+
+        self.assertIn('<b>Leaf</b>', html)
+        self.assertLess(html.index('level-4'), html.index('level-0'))
+
+    def test_render_result_shared_between_tags(self):
+        page = Page.objects.create(slug='scripted_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {'type': 'pageblocks.tests.ScriptedHTMLBlock', 'data': {'html': '<b>%d</b>' % i, 'script': script}, 'i18n_data': {}}
+            for i, script in enumerate(['zebra', 'apple', 'zebra'])
+        ])
+
+        with translation_override('en'), self.assertNumQueries(1):
+            html = pageblocks(page)
+            scripts = pageblocks_scripts(page)
+            stylesheets = pageblocks_stylesheets(page)
+
+        self.assertEqual(html, '<b>0</b><b>1</b><b>2</b>')
+        self.assertEqual(scripts, '\n'.join([
+            '<script type="text/javascript" src="/static/zebra.js"></script>',
+            '<script type="text/javascript" src="/static/common.js"></script>',
+            '<script type="text/javascript" src="/static/apple.js"></script>',
+        ]))
+        self.assertEqual(stylesheets, '<link href="/static/common.css" rel="stylesheet" />')
+
+    @override_settings(PAGEBLOCKS_SNAPSHOTS=True)
+    def test_render_from_snapshot(self):
+        image = Image.objects.create(image='pageblocks/snapshot.png')
+        page = Page.objects.create(slug='snapshot_page', title={'en': 'test'})
+        image_block = PageBlock.objects.create(page=page, type='pageblocks.blocks.ImageBlock', data={'image_id': str(image.id)})
+        BlockProcessor().save(page, [
+            {'id': str(image_block.id), 'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': image.image.url}, 'i18n_data': {}},
+            {'type': 'pageblocks.blocks.ContainerBlock', 'data': {'class': 'row', 'blocks': [
+                {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>Hello</b>'}, 'i18n_data': {'es': {'html': '<b>Hola</b>'}}},
+            ]}},
+        ])
+
+        page = Page.objects.get(pk=page.pk)
+        with self.assertNumQueries(0):
+            with translation_override('en'):
+                english = pageblocks(page)
+            with translation_override('es'):
+                spanish = pageblocks(page)
+
+        self.assertEqual(english, '<img src="%s" loading="lazy" /><div class="row"><b>Hello</b></div>' % image.image.url)
+        self.assertEqual(spanish, '<img src="%s" loading="lazy" /><div class="row"><b>Hola</b></div>' % image.image.url)
+
+        with override_settings(PAGEBLOCKS_SNAPSHOTS=False):
+            BlockProcessor().save(page, [])
+        self.assertIsNone(Page.objects.get(pk=page.pk).block_snapshot)
+
+    def test_block_templates_compiled_once(self):
+        page = self.create_nested_page(depth=2)
+        registry.reset_templates()
+
+        with mock.patch('pageblocks.registry.get_template', wraps=get_template) as get_template_mock:
+            with translation_override('en'):
+                pageblocks(page)
+                pageblocks(Page.objects.get(pk=page.pk))
+            self.assertEqual(get_template_mock.call_count, 2)
+
+            with override_settings(DEBUG=True), translation_override('en'):
+                pageblocks(Page.objects.get(pk=page.pk))
+            self.assertGreater(get_template_mock.call_count, 4)
+
+    def test_image_urls_resolved_in_one_query(self):
+        images = [Image.objects.create(image='pageblocks/gallery_%d.png' % i) for i in range(5)]
+        page = Page.objects.create(slug='gallery', title={'en': 'gallery'})
+        PageBlock.objects.bulk_create([
+            PageBlock(page=page, index=index, type='pageblocks.blocks.ImageBlock',
+                      data={'image_id': str(image.id)}, i18n_data={'es': {'alt': 'Imagen'}})
+            for index, image in enumerate(images)
+        ])
+
+        with translation_override('en'), self.assertNumQueries(2):
+            html = pageblocks(page)
+
+        for image in images:
+            self.assertIn(image.image.url, html)
+
+
+@override_settings(LANGUAGES=[
+    ('es', gettext_lazy('Spanish')),
+    ('en', gettext_lazy('English')),
+], LANGUAGE_CODE='en', PAGEBLOCKS_PAGE_CACHE=True, CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pageblocks-tests'}
+})
+class PageCacheTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_cached_render_invalidated_on_save(self):
+        page = Page.objects.create(slug='cached_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>First</b>'}, 'i18n_data': {}}
+        ])
+
+        with translation_override('en'):
+            self.assertEqual(pageblocks(page), '<b>First</b>')
+            with self.assertNumQueries(0):
+                self.assertEqual(pageblocks(page), '<b>First</b>')
+
+        BlockProcessor().save(page, [
+            {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>Second</b>'}, 'i18n_data': {}}
+        ])
+
+        with translation_override('en'):
+            self.assertEqual(pageblocks(Page.objects.get(pk=page.pk)), '<b>Second</b>')
+
+    @override_settings(PAGEBLOCKS_PAGE_CACHE=False, PAGEBLOCKS_BLOCK_CACHE=True)
+    def test_block_cache_shared_across_pages(self):
+        block_data = {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>Footer</b>'},
+                      'i18n_data': {'es': {'html': '<b>Pie</b>'}}}
+        first_page = Page.objects.create(slug='first_page', title={'en': 'first'})
+        second_page = Page.objects.create(slug='second_page', title={'en': 'second'})
+        BlockProcessor().save(first_page, [dict(block_data)])
+        BlockProcessor().save(second_page, [dict(block_data)])
+
+        with mock.patch.object(HTMLBlock, 'get_render_context_data', autospec=True,
+                               side_effect=HTMLBlock.get_render_context_data) as render_mock:
+            with translation_override('en'):
+                self.assertEqual(pageblocks(first_page), '<b>Footer</b>')
+                self.assertEqual(pageblocks(second_page), '<b>Footer</b>')
+            self.assertEqual(render_mock.call_count, 1)
+
+            with translation_override('es'):
+                self.assertEqual(pageblocks(second_page), '<b>Pie</b>')
+            self.assertEqual(render_mock.call_count, 2)
+
+
+class TestPageView(PageView):
+    template_name = 'pageblocks/blocks/html.html'
+    queryset = Page.objects.all()
+
+
+class TestAsyncPageView(AsyncPageView):
+    template_name = 'streamed_page.html'
+    queryset = Page.objects.all()
+
+
+@override_settings(LANGUAGES=[
+    ('es', gettext_lazy('Spanish')),
+    ('en', gettext_lazy('English')),
+], LANGUAGE_CODE='en')
+class PageViewTestCase(TestCase):
+    def setUp(self):
+        self.page = Page.objects.create(slug='view_page', title={'en': 'test'})
+        BlockProcessor().save(self.page, [
+            {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>First</b>'}, 'i18n_data': {}}
+        ])
+
+    def get(self, **headers):
+        request = RequestFactory().get('/view_page/', **headers)
+        with translation_override('en'):
+            return TestPageView.as_view()(request, slug='view_page')
+
+    def test_conditional_get(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        BlockProcessor().save(self.page, [
+            {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>Second</b>'}, 'i18n_data': {}}
+        ])
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        etag = response['ETag']
+        self.page.title = {'en': 'Changed'}
+        self.page.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'loaders': [
+                ('django.template.loaders.locmem.Loader', {
+                    'streamed_page.html': '{% load pageblocks %}<body>{% pageblocks page %}</body>',
+                }),
+                'django.template.loaders.app_directories.Loader',
+            ],
+        },
+    }], PAGEBLOCKS_PAGE_CACHE=True, PAGEBLOCKS_RENDER_TIMEOUT=0.2)
+    def test_timed_out_render_not_kept(self):
+        caches['default'].clear()
+        SlowOnceHTMLBlock.calls = 0
+        BlockProcessor().save(self.page, [
+            {'type': 'pageblocks.tests.SlowOnceHTMLBlock', 'data': {'html': '<b>Slow</b>'}, 'i18n_data': {}}
+        ])
+
+        class BlocksPageView(TestPageView):
+            template_name = 'streamed_page.html'
+
+        def get(**headers):
+            request = RequestFactory().get('/view_page/', **headers)
+            with translation_override('en'):
+                response = BlocksPageView.as_view()(request, slug='view_page')
+                if hasattr(response, 'render'):
+                    response.render()
+            return response
+
+        with self.assertLogs(level='WARNING'):
+            response = get()
+        self.assertEqual(response.content.decode(), '<body><!-- timed out --></body>')
+        self.assertNotIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+        response = get()
+        self.assertEqual(response.content.decode(), '<body><b>Slow</b>:en</body>')
+        self.assertEqual(get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # The complete render is the one that's cached
+        with translation_override('en'):
+            self.assertEqual(pageblocks(Page.objects.get(pk=self.page.pk)), '<b>Slow</b>:en')
+        self.assertEqual(SlowOnceHTMLBlock.calls, 2)
+
+        class StreamingPageView(BlocksPageView):
+            streaming = True
+
+        request = RequestFactory().get('/view_page/')
+        with translation_override('en'):
+            self.assertNotIn('ETag', StreamingPageView.as_view()(request, slug='view_page'))
+
+    @override_settings(PAGEBLOCKS_BLOCK_CACHE=True, PAGEBLOCKS_SLOW_REQUEST_THRESHOLD=0)
+    def test_server_timing(self):
+        caches['default'].clear()
+        rendered = []
+
+        def view(request):
+            with translation_override('en'):
+                return HttpResponse(pageblocks(Page.objects.get(pk=self.page.pk)))
+
+        def receiver(sender, **kwargs):
+            rendered.append(kwargs)
+
+        block_rendered.connect(receiver)
+        try:
+            with self.assertLogs(level='WARNING') as logs:
+                first = ServerTimingMiddleware(view)(RequestFactory().get('/view_page/'))
+                ServerTimingMiddleware(view)(RequestFactory().get('/view_page/'))
+        finally:
+            block_rendered.disconnect(receiver)
+
+        self.assertIn('pageblocks-block;dur=', first['Server-Timing'])
+        self.assertIn('pageblocks-render;dur=', first['Server-Timing'])
+        self.assertIn('pageblocks.blocks.HTMLBlock %s' % self.page.blocks.get().id, logs.output[0])
+        self.assertIn('0 cache hits, 1 misses', logs.output[0])
+        self.assertIn('1 cache hits, 0 misses', logs.output[1])
+        self.assertEqual([record['cache'] for record in rendered], ['miss', 'hit'])
+        self.assertEqual(rendered[0]['block_id'], str(self.page.blocks.get().id))
+
+    def test_export_pages(self):
+        Page.objects.create(slug='second_view_page', title={'en': 'second'})
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            out = StringIO()
+            call_command('exportpageblocks', output_dir, view='pageblocks.tests.TestPageView', workers=1,
+                         chunk_size=1, incremental=True, stdout=out)
+            self.assertIn('Exported 2 page(s)', out.getvalue())
+            for language in ('en', 'es'):
+                self.assertTrue(os.path.exists(os.path.join(output_dir, language, 'view_page', 'index.html')))
+
+            BlockProcessor().save(self.page, [
+                {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>Second</b>'}, 'i18n_data': {}}
+            ])
+            out = StringIO()
+            call_command('exportpageblocks', output_dir, view='pageblocks.tests.TestPageView', workers=1,
+                         incremental=True, stdout=out)
+            self.assertIn('Exported 1 page(s)', out.getvalue())
+
+    def test_export_pages_in_worker_processes(self):
+        for i in range(5):
+            Page.objects.create(slug='worker_page_%d' % i, title={'en': 'worker'})
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            out = StringIO()
+            call_command('exportpageblocks', output_dir, view='pageblocks.tests.TestPageView', workers=2,
+                         chunk_size=2, stdout=out)
+            self.assertIn('Exported 6 page(s)', out.getvalue())
+            for slug in ['view_page'] + ['worker_page_%d' % i for i in range(5)]:
+                self.assertTrue(os.path.exists(os.path.join(output_dir, 'es', slug, 'index.html')))
+            with open(os.path.join(output_dir, '.pageblocks-export.json')) as f:
+                self.assertEqual(len(json.load(f)), 6)
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'loaders': [
+                ('django.template.loaders.locmem.Loader', {
+                    'streamed_page.html': '{% load pageblocks %}<head>{% pageblocks_scripts page %}</head>'
+                                          '<body>{% pageblocks page %}</body>',
+                }),
+                'django.template.loaders.app_directories.Loader',
+            ],
+        },
+    }])
+    def test_streaming_response(self):
+        BlockProcessor().save(self.page, [
+            {'type': 'pageblocks.tests.ScriptedHTMLBlock', 'data': {'html': '<b>First</b>', 'script': 'first'}, 'i18n_data': {}},
+            {'type': 'pageblocks.blocks.HTMLBlock', 'data': {'html': '<b>Second</b>'}, 'i18n_data': {}},
+        ])
+
+        class StreamingPageView(TestPageView):
+            template_name = 'streamed_page.html'
+            streaming = True
+
+        with translation_override('en'):
+            response = StreamingPageView.as_view()(RequestFactory().get('/view_page/'), slug='view_page')
+        self.assertTrue(response.streaming)
+
+        chunks = [chunk.decode() for chunk in response.streaming_content]
+        self.assertEqual(chunks, [
+            '<head><script type="text/javascript" src="/static/first.js"></script>\n'
+            '<script type="text/javascript" src="/static/common.js"></script></head><body>',
+            '<b>First</b>',
+            '<b>Second</b>',
+            '</body>',
+        ])
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'loaders': [
+                ('django.template.loaders.locmem.Loader', {
+                    'streamed_page.html': '{% load pageblocks %}<head>{% pageblocks_scripts page %}</head>'
+                                          '<body>{% pageblocks page %}</body>',
+                }),
+                'django.template.loaders.app_directories.Loader',
+            ],
+        },
+    }])
+    async def test_async_page_view(self):
+        await sync_to_async(BlockProcessor().save)(self.page, [
+            {'type': 'pageblocks.tests.SlowHTMLBlock', 'data': {'html': '<b>First</b>'}, 'i18n_data': {}},
+            {'type': 'pageblocks.blocks.ContainerBlock', 'data': {'class': 'row', 'blocks': [
+                {'type': 'pageblocks.tests.SlowHTMLBlock', 'data': {'html': '<i>Nested</i>'}, 'i18n_data': {}},
+                {'type': 'pageblocks.tests.ScriptedHTMLBlock', 'data': {'html': '<b>Scripted</b>'}, 'i18n_data': {}},
+            ]}},
+            {'type': 'pageblocks.tests.SlowHTMLBlock', 'data': {'html': '<b>Last</b>'}, 'i18n_data': {}},
+        ])
+
+        with translation_override('en'):
+            start = time.perf_counter()
+            response = await TestAsyncPageView.as_view()(RequestFactory().get('/view_page/'), slug='view_page')
+            # The slow blocks wait at the same time rather than one after another
+            self.assertLess(time.perf_counter() - start, 0.5)
+            await sync_to_async(response.render)()
+
+        self.assertEqual(response.content.decode(), (
+            '<head><script type="text/javascript" src="/static/common.js"></script></head>'
+            '<body><b>First</b><div class="row"><i>Nested</i><b>Scripted</b></div><b>Last</b></body>'
+        ))
+        self.assertIn('ETag', response)
+
+        class StreamingPageView(TestAsyncPageView):
+            streaming = True
+
+        with translation_override('en'):
+            response = await StreamingPageView.as_view()(RequestFactory().get('/view_page/'), slug='view_page')
+            chunks = [chunk.decode() async for chunk in response.streaming_content]
+        self.assertEqual(chunks[1:], ['<b>First</b>', '<div class="row"><i>Nested</i><b>Scripted</b></div>', '<b>Last</b>', '</body>'])
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'loaders': [
+                ('django.template.loaders.locmem.Loader', {
+                    'streamed_page.html': '{% load pageblocks %}<head>{% pageblocks_scripts page %}</head>'
+                                          '<body>{% pageblocks page %}</body>',
+                }),
+                'django.template.loaders.app_directories.Loader',
+            ],
+        },
+    }])
+    async def test_async_page_view_with_queries(self):
+        await sync_to_async(BlockProcessor().save)(self.page, [
+            {'type': 'pageblocks.tests.QueryingHTMLBlock', 'data': {'html': '<b>Count</b>'}, 'i18n_data': {}},
+            {'type': 'pageblocks.blocks.ContainerBlock', 'data': {'class': 'row', 'blocks': [
+                {'type': 'pageblocks.tests.QueryingHTMLBlock', 'data': {'html': '<i>Nested</i>'}, 'i18n_data': {}},
+            ]}},
+        ])
+        expected = ('<head><script type="text/javascript" src="/static/view_page.js"></script></head>'
+                    '<body><b>Count</b>:1<div class="row"><i>Nested</i>:1</div></body>')
+
+        with translation_override('en'):
+            response = await TestAsyncPageView.as_view()(RequestFactory().get('/view_page/'), slug='view_page')
+            await sync_to_async(response.render)()
+        self.assertEqual(response.content.decode(), expected)
+
+        class StreamingPageView(TestAsyncPageView):
+            streaming = True
+
+        with translation_override('en'):
+            response = await StreamingPageView.as_view()(RequestFactory().get('/view_page/'), slug='view_page')
+            self.assertEqual(''.join([chunk.decode() async for chunk in response.streaming_content]), expected)
+
+
+    async def test_async_render_counts_queries(self):
+        await sync_to_async(BlockProcessor().save)(self.page, [
+            {'type': 'pageblocks.tests.QueryingHTMLBlock', 'data': {'html': '<b>Count</b>'}, 'i18n_data': {}},
+            {'type': 'pageblocks.blocks.ContainerBlock', 'data': {'class': 'row', 'blocks': [
+                {'type': 'pageblocks.tests.QueryingHTMLBlock', 'data': {'html': '<i>Nested</i>'}, 'i18n_data': {}},
+                {'type': 'pageblocks.tests.QueryingHTMLBlock', 'data': {'html': '<i>Nested</i>'}, 'i18n_data': {}},
+            ]}},
+        ])
+        processor = BlockProcessor()
+        blocks = await processor.aload_tree(self.page, use_snapshot=False)
+
+        def sync_summary():
+            with collect() as collector, translation_override('en'):
+                processor.render(blocks)
+            return collector.get_summary()
+
+        with collect() as collector, translation_override('en'):
+            await processor.arender(blocks)
+        summary = collector.get_summary()
+        self.assertEqual(summary['block']['queries'], 3 + 2)
+        self.assertEqual(summary['render']['queries'], 3 + 2)
+        expected = await sync_to_async(sync_summary)()
+        self.assertEqual({kind: totals['queries'] for kind, totals in summary.items()},
+                         {kind: totals['queries'] for kind, totals in expected.items()})
+
+class ImageUploadTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings_override.enable()
+        self.user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media_root.cleanup()
+
+    def get_png(self, color='red', size=(4, 4)):
+        buffer = BytesIO()
+        PILImage.new('RGB', size, color).save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    def upload(self, content):
+        request = RequestFactory().post('/upload-image/', {'image': SimpleUploadedFile('photo.png', content)})
+        request.user = self.user
+        return PageAdmin(Page, AdminSite()).upload_image_view(request)
+
+    def test_upload_and_reference_image(self):
+        response = self.upload(self.get_png())
+        self.assertEqual(response.status_code, 200)
+        uploaded = json.loads(response.content)
+        image = Image.objects.get(id=uploaded['id'])
+        self.assertEqual(uploaded['url'], image.image.url)
+
+        page = Page.objects.create(slug='upload_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': uploaded}, 'i18n_data': {'es': {'alt': 'Imagen'}}}
+        ])
+        self.assertEqual(page.blocks.get().data['image_id'], uploaded['id'])
+        self.assertTrue(Image.objects.filter(id=uploaded['id']).exists())
+
+    def test_upload_rejects_non_images(self):
+        response = self.upload(b'not an image')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Image.objects.exists())
+
+    @override_settings(PAGEBLOCKS_IMAGE_WIDTHS=[200, 400, 2000], PAGEBLOCKS_IMAGE_FORMATS=['webp'],
+                       PAGEBLOCKS_IMAGE_SIZES='50vw')
+    def test_responsive_derivatives(self):
+        image = Image.objects.get(id=json.loads(self.upload(self.get_png(size=(1000, 500))).content)['id'])
+        self.assertEqual((image.width, image.height), (1000, 500))
+
+        generate_derivatives(image)
+        image = Image.objects.get(id=image.id)
+        self.assertEqual(sorted(image.derivatives.keys()), ['png', 'webp'])
+        self.assertEqual(image.image_format, 'png')
+        self.assertEqual(sorted(image.derivatives['png'].keys()), ['200', '400'])
+
+        page = Page.objects.create(slug='responsive_page', title={'en': 'test'})
+        PageBlock.objects.create(page=page, index=0, type='pageblocks.blocks.ImageBlock', data={'image_id': str(image.id)})
+        with translation_override('en'):
+            html = pageblocks(page)
+
+        storage = image.image.storage
+        self.assertIn('<source type="image/webp" srcset="%s 200w, %s 400w" sizes="50vw" />' % (
+            storage.url(image.derivatives['webp']['200']), storage.url(image.derivatives['webp']['400'])), html)
+        self.assertIn('srcset="%s 200w, %s 400w, %s 1000w" sizes="50vw" width="1000" height="500" loading="lazy"' % (
+            storage.url(image.derivatives['png']['200']), storage.url(image.derivatives['png']['400']), image.image.url), html)
+
+        # The original format doesn't depend on the order the derivatives come back from the database in
+        Image.objects.filter(pk=image.pk).update(derivatives={'webp': image.derivatives['webp'], 'png': image.derivatives['png']})
+        page = Page.objects.get(pk=page.pk)
+        with translation_override('en'):
+            self.assertEqual(pageblocks(page), html)
+
+        image.delete()
+        self.assertFalse(storage.exists(image.derivatives['png']['200']))
+
+    @override_settings(PAGEBLOCKS_SNAPSHOTS=True, PAGEBLOCKS_IMAGE_WIDTHS=[200])
+    def test_snapshots_follow_image_changes(self):
+        image = Image.objects.get(id=json.loads(self.upload(self.get_png(size=(1000, 500))).content)['id'])
+        page = Page.objects.create(slug='snapshot_image_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': {'id': str(image.id)}}, 'i18n_data': {}},
+        ])
+        self.assertNotIn('srcset', pageblocks(Page.objects.get(pk=page.pk)))
+        version = page.content_version
+
+        generate_derivatives(image)
+        page.refresh_from_db()
+        self.assertGreater(page.content_version, version)
+        with self.assertNumQueries(0), translation_override('en'):
+            self.assertIn('200w', pageblocks(page))
+
+        delete_images([Image.objects.get(pk=image.pk)])
+        page = Page.objects.get(pk=page.pk)
+        self.assertEqual(page.block_snapshot['blocks'][0]['extra'], {'images': {}})
+
+    @override_settings(PAGEBLOCKS_PAGE_CACHE=True, PAGEBLOCKS_IMAGE_WIDTHS=[200])
+    def test_cached_pages_follow_image_changes(self):
+        caches['default'].clear()
+        image = Image.objects.get(id=json.loads(self.upload(self.get_png(size=(1000, 500))).content)['id'])
+        page = Page.objects.create(slug='cached_image_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': {'id': str(image.id)}}, 'i18n_data': {}},
+        ])
+        with translation_override('en'):
+            self.assertNotIn('srcset', pageblocks(Page.objects.get(pk=page.pk)))
+        version = page.content_version
+
+        generate_derivatives(image)
+        page = Page.objects.get(pk=page.pk)
+        self.assertGreater(page.content_version, version)
+        with translation_override('en'):
+            self.assertIn('200w', pageblocks(page))
+
+    @override_settings(PAGEBLOCKS_SNAPSHOTS=True)
+    def test_rebuild_snapshots(self):
+        page = Page.objects.create(slug='rebuilt_page', title={'en': 'test'})
+        PageBlock.objects.create(page=page, index=0, type='pageblocks.blocks.HTMLBlock', data={'html': '<b>Raw</b>'})
+        Page.objects.create(slug='second_rebuilt_page', title={'en': 'test'})
+
+        out = StringIO()
+        call_command('rebuildpageblocksnapshots', '--batch-size=1', stdout=out)
+        self.assertIn('Rebuilt the snapshots of 2 page(s)', out.getvalue())
+        page = Page.objects.get(pk=page.pk)
+        self.assertEqual(page.content_version, 1)
+        with self.assertNumQueries(0), translation_override('en'):
+            self.assertEqual(pageblocks(page), '<b>Raw</b>')
+
+        with self.settings(PAGEBLOCKS_SNAPSHOTS=False), self.assertRaises(CommandError):
+            call_command('rebuildpageblocksnapshots', stdout=StringIO())
+
+    @override_settings(PAGEBLOCKS_IMAGE_DERIVATIVES='request')
+    def test_derivatives_scheduled_on_first_request(self):
+        image = Image.objects.get(id=json.loads(self.upload(self.get_png()).content)['id'])
+        page = Page.objects.create(slug='scheduled_page', title={'en': 'test'})
+        PageBlock.objects.create(page=page, index=0, type='pageblocks.blocks.ImageBlock', data={'image_id': str(image.id)})
+
+        with mock.patch('pageblocks.blocks.schedule_derivatives') as schedule_mock, translation_override('en'):
+            pageblocks(page)
+        schedule_mock.assert_called_once_with(image.id)
+
+    def test_identical_images_stored_once(self):
+        first = json.loads(self.upload(self.get_png()).content)
+        second = json.loads(self.upload(self.get_png()).content)
+        self.assertEqual(first['id'], second['id'])
+        self.assertNotEqual(json.loads(self.upload(self.get_png(color='blue')).content)['id'], first['id'])
+
+        page = Page.objects.create(slug='shared_image_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': first}, 'i18n_data': {}},
+            {'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': second}, 'i18n_data': {}},
+        ])
+        image = Image.objects.get(id=first['id'])
+        self.assertEqual(image.ref_count, 2)
+
+        edit_data = BlockProcessor().blocks_to_representation(page.blocks.filter(parent=None))
+        BlockProcessor().save(page, edit_data[:1])
+        self.assertEqual(Image.objects.get(id=first['id']).ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BlockProcessor().save(page, [])
+        self.assertFalse(Image.objects.filter(id=first['id']).exists())
+        self.assertFalse(image.image.storage.exists(image.image.name))
+
+    def test_clean_orphaned_images(self):
+        used = json.loads(self.upload(self.get_png()).content)
+        orphan = Image.objects.get(id=json.loads(self.upload(self.get_png(color='blue')).content)['id'])
+        translated = json.loads(self.upload(self.get_png(color='green')).content)
+
+        page = Page.objects.create(slug='gc_page', title={'en': 'test'})
+        BlockProcessor().save(page, [
+            {'type': 'pageblocks.blocks.ImageBlock', 'data': {'image': used}, 'i18n_data': {}},
+        ])
+        PageBlock.objects.create(page=page, index=1, type='pageblocks.blocks.ImageBlock',
+                                 data={'image_id': used['id']}, i18n_data={'es': {'image_id': translated['id']}})
+
+        out = StringIO()
+        call_command('cleanpageblockimages', '--dry-run', '--min-age=0', stdout=out)
+        self.assertIn('1 orphaned image(s) would be deleted', out.getvalue())
+        call_command('cleanpageblockimages', stdout=StringIO())
+        self.assertTrue(Image.objects.filter(id=orphan.id).exists())
+
+        call_command('cleanpageblockimages', '--min-age=0', '--batch-size=1', stdout=out)
+        self.assertIn('Deleted 1 orphaned image(s)', out.getvalue())
+        self.assertEqual(set(str(image_id) for image_id in Image.objects.values_list('id', flat=True)),
+                         {used['id'], translated['id']})
+        self.assertFalse(orphan.image.storage.exists(orphan.image.name))
+
+        # a reference count that has drifted won't release the image, but the collector still finds it
+        Image.objects.filter(id=translated['id']).update(ref_count=5)
+        with self.settings(PAGEBLOCKS_IMAGE_GC_ON_SAVE=True), self.captureOnCommitCallbacks(execute=True):
+            BlockProcessor().save(page, [])
+        self.assertFalse(Image.objects.exists())
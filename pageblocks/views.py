@@ -1,16 +1,36 @@
-from django.http.response import Http404
+import uuid
+from calendar import timegm
+
+from asgiref.sync import sync_to_async
+
+from django.http.response import Http404, StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.utils import translation
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.translation import get_language, gettext
 from django.views.generic.base import TemplateView
-from django.utils.translation import gettext
+
+from .blocks import BlockProcessor
 
 
 class PageView(TemplateView):
     template_name = None
     queryset = None
 
+    # Answer conditional GET requests from the page's content version and modification time.  Turn this
+    # off if your page template includes content that changes independently of the page
+    conditional_response = True
+
+    # Stream the response, sending everything before {% pageblocks page %} straight away and then each top
+    # level block as soon as it's rendered
+    streaming = False
+
     def get_queryset(self):
-        if not self.queryset:
+        if self.queryset is None:
             raise Exception(gettext('No queryset provided.  This view must provide either a queryset attribute or get_queryset function'))
-        return self.queryset
+        # Checking the queryset's truthiness would fetch every page, and the shared queryset shouldn't keep results
+        return self.queryset.all()
 
     def get_object(self, *args, **kwargs):
         slug = self.kwargs.get('slug', None)
@@ -23,7 +43,132 @@ class PageView(TemplateView):
 
         return obj
 
+    def get_etag(self):
+        # The modification time covers changes to the page's own fields, which don't bump content_version
+        return quote_etag('%s-%s-%s-%s' % (
+            self.object.pk, self.object.content_version, self.object.modified.timestamp(), get_language()
+        ))
+
+    def get_last_modified(self):
+        return self.object.modified
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        response = self.get_not_modified_response(request)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        return self.add_conditional_headers(response)
+
+    def get_not_modified_response(self, request):
+        """
+        A 304 (or 412) response if the client's copy of the page is still current, otherwise None
+        """
+        if not self.conditional_response:
+            return None
+
+        last_modified = self.get_last_modified()
+        return get_conditional_response(request, etag=self.get_etag(),
+                                        last_modified=timegm(last_modified.utctimetuple()) if last_modified else None)
+
+    def add_conditional_headers(self, response):
+        if not self.conditional_response:
+            return response
+
+        if response.streaming:
+            # The headers go out before the blocks are rendered, so there's no telling whether one will time out
+            processor = BlockProcessor()
+            if processor.may_time_out(processor.get_page_blocks(self.object)):
+                return response
+
+        etag = self.get_etag()
+        last_modified = self.get_last_modified()
+        if etag and not response.has_header('ETag'):
+            response['ETag'] = etag
+        if last_modified and not response.has_header('Last-Modified'):
+            response['Last-Modified'] = http_date(timegm(last_modified.utctimetuple()))
+
+        if hasattr(response, 'add_post_render_callback'):
+            response.add_post_render_callback(self.check_render_complete)
+        return response
+
+    def check_render_complete(self, response):
+        """
+        Drop the conditional headers from a response where a block timed out and was replaced by its
+        placeholder, so clients fetch the page again rather than revalidating the degraded copy
+        """
+        render_results = self.object.__dict__.get('_pageblocks_render_results', {})
+        if not all(render_result.complete for render_result in render_results.values()):
+            del response['ETag']
+            del response['Last-Modified']
+            response['Cache-Control'] = 'no-cache'
+
+    def render_to_response(self, context, **response_kwargs):
+        if not self.streaming:
+            return super().render_to_response(context, **response_kwargs)
+        return self.render_to_streaming_response(context, **response_kwargs)
+
+    def render_to_streaming_response(self, context, **response_kwargs):
+        page = context['page']
+        page._pageblocks_stream_marker = '<!-- pageblocks:%s -->' % uuid.uuid4().hex
+        head, marker, tail = render_to_string(self.get_template_names(), context,
+                                              request=self.request).partition(page._pageblocks_stream_marker)
+
+        response_kwargs.setdefault('content_type', self.content_type)
+        # The content is consumed after the view returns, so hang on to the language it should render in
+        return StreamingHttpResponse(self.stream(page, head, marker, tail, get_language()), **response_kwargs)
+
+    def stream(self, page, head, marker, tail, language):
+        yield head
+        if marker:
+            with translation.override(language):
+                processor = BlockProcessor()
+                yield from processor.render_iter(processor.get_page_blocks(page))
+        yield tail
+
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
-        ctx['page'] = self.get_object()
-        return ctx
\ No newline at end of file
+        ctx['page'] = self.object if hasattr(self, 'object') else self.get_object()
+        return ctx
+
+
+class AsyncPageView(PageView):
+    """
+    A PageView for ASGI deployments.  The page and its blocks are loaded with the async ORM and the blocks are
+    rendered concurrently (see BaseBlock.arender) before the template is rendered.  Streaming responses need
+    Django 4.2 or later, which added support for async iterators
+    """
+
+    async def get(self, request, *args, **kwargs):
+        self.object = await self.aget_object()
+        response = self.get_not_modified_response(request)
+        if response is None:
+            processor = BlockProcessor()
+            if self.streaming:
+                # The template still needs the tree for {% pageblocks_scripts %} etc.
+                await processor.aget_page_blocks(self.object)
+            else:
+                # Rendered here so the template tags find the result waiting for them
+                await processor.arender_page(self.object)
+            # Streaming responses render the page template straight away, which may query the database
+            response = await sync_to_async(self.render_to_response)(self.get_context_data(**kwargs))
+        return self.add_conditional_headers(response)
+
+    async def aget_object(self, *args, **kwargs):
+        slug = self.kwargs.get('slug', None)
+        if not slug:
+            raise Exception(gettext('Expecting a slug parameter on the url.  You can override this behaviour by overriding the get_object function'))
+
+        obj = await self.get_queryset().filter(slug=slug).afirst()
+        if not obj:
+            raise Http404()
+
+        return obj
+
+    async def stream(self, page, head, marker, tail, language):
+        yield head
+        if marker:
+            with translation.override(language):
+                processor = BlockProcessor()
+                async for html in processor.arender_iter(await processor.aget_page_blocks(page)):
+                    yield html
+        yield tail